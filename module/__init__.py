@@ -49,7 +49,6 @@ class CustomDumper(yaml.Dumper):
 
 LOG_TIME_FORMAT = '[%Y-%m-%d %H:%M:%S]'
 console = Console(log_path=False, log_time_format=LOG_TIME_FORMAT)
-MAX_FILE_REFERENCE_TIME = 600
 Session.WAIT_TIMEOUT = 100
 Session.START_TIMEOUT = 60
 SLEEP_THRESHOLD = 60
@@ -72,6 +71,7 @@ MAX_RECORD_LENGTH = 1000
 read_input_history(history_path=INPUT_HISTORY_PATH, max_record_len=MAX_RECORD_LENGTH, platform=PLATFORM)
 # 配置日志输出到文件
 LOG_PATH = os.path.join(APPDATA_PATH, f'{SOFTWARE_SHORT_NAME}_LOG.log')
+LEDGER_PATH = os.path.join(APPDATA_PATH, f'{SOFTWARE_SHORT_NAME}_LEDGER.db')  # 下载水位等持久化记录。
 MAX_LOG_SIZE = 200 * 1024 * 1024  # 200MB
 BACKUP_COUNT = 0  # 不保留日志文件。
 LINK_PREVIEW_OPTIONS = LinkPreviewOptions(is_disabled=True)
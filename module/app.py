@@ -14,11 +14,9 @@ from typing import Union
 import pyrogram
 
 from module import (
-    Session,
     SLEEP_THRESHOLD,
     console,
     log,
-    MAX_FILE_REFERENCE_TIME,
     SOFTWARE_FULL_NAME
 )
 from module.language import _t
@@ -51,7 +49,6 @@ class Application(UserConfig, StatisticalTable):
     def build_client(self) -> pyrogram.Client:
         """用填写的配置文件,构造pyrogram客户端。"""
         os.makedirs(self.work_directory, exist_ok=True)
-        Session.WAIT_TIMEOUT = min(Session.WAIT_TIMEOUT + self.max_download_task ** 2, MAX_FILE_REFERENCE_TIME)
         return TelegramRestrictedMediaDownloaderClient(
             name=SOFTWARE_FULL_NAME.replace(' ', ''),
             api_id=self.api_id,
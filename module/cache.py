@@ -0,0 +1,49 @@
+# coding=UTF-8
+# Author:Gentlesprite
+# Software:PyCharm
+# Time:2026/10/18 21:40
+# File:cache.py
+import time
+
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """有容量上限的LRU缓存,每个条目在写入ttl秒后过期。"""
+    MISSING = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600):
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.__data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self.__data.get(key)
+        if item is None:
+            return default
+        expire, value = item
+        if expire < time.monotonic():
+            self.__data.pop(key, None)
+            return default
+        self.__data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        self.__data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self.__data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        self.__data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, TTLCache.MISSING) is not TTLCache.MISSING
+
+    def __len__(self) -> int:
+        return len(self.__data)
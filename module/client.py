@@ -5,12 +5,14 @@
 # File:client.py
 import asyncio
 from datetime import datetime
-from typing import AsyncGenerator, Optional, Union, List
+from typing import AsyncGenerator, Callable, Optional, Union, List
 
 import pyrogram
 from pyrogram.qrlogin import QRLogin
 from pyrogram import raw, types, utils
+from pyrogram.file_id import FileId, FileType
 from pyrogram.errors.exceptions import PhoneNumberInvalid
+from pyrogram.errors.exceptions.flood_420 import FloodWait
 
 from module import (
     console,
@@ -18,9 +20,67 @@ from module import (
     log,
     __version__
 )
-from module.enums import KeyWord
+from module.cache import TTLCache
+from module.enums import KeyWord, DownloadType
 from module.language import _t
 
+SEEK_CACHE = TTLCache(maxsize=1024, ttl=3600)  # 日期对应的消息ID,键为(频道,时间戳)。
+PAGE_CACHE = TTLCache(maxsize=256, ttl=1800)  # 聊天记录分页及其hash,键为GetHistory的请求参数。
+
+
+class MessageRecord:
+    """直接从原始TL消息读取的精简记录,只包含扫描筛选所需的字段,可代替Message传给Filter。"""
+    __slots__ = ('id', 'date', 'media_group_id', 'media', 'file_size')
+
+    def __init__(self, message: raw.base.Message):
+        self.id: int = message.id
+        self.date: Union[datetime, None] = utils.timestamp_to_datetime(getattr(message, 'date', None))
+        self.media_group_id: Union[int, None] = getattr(message, 'grouped_id', None)
+        self.media: Union[str, None] = None
+        self.file_size: int = 0
+        media = getattr(message, 'media', None)
+        if isinstance(media, raw.types.MessageMediaPhoto) and isinstance(media.photo, raw.types.Photo):
+            self.media = DownloadType.PHOTO
+            self.file_size = max(
+                (max(_.sizes) if isinstance(_, raw.types.PhotoSizeProgressive) else getattr(_, 'size', 0)
+                 for _ in media.photo.sizes),
+                default=0
+            )
+        elif isinstance(media, raw.types.MessageMediaDocument) and isinstance(media.document, raw.types.Document):
+            self.media = MessageRecord.document_type(media.document)
+            self.file_size = media.document.size
+
+    def __getattr__(self, name: str):
+        # 与Message一致,通过getattr(message,'video')等判断媒体类型。
+        if name in DownloadType() or name in ('sticker', 'video_note'):
+            return self.media == name
+        raise AttributeError(name)
+
+    @staticmethod
+    def document_type(document: raw.types.Document) -> str:
+        """与pyrogram解析Message时的判断顺序保持一致。"""
+        attributes: dict = {type(_): _ for _ in document.attributes}
+        video = attributes.get(raw.types.DocumentAttributeVideo)
+        if raw.types.DocumentAttributeAnimated in attributes:
+            return 'video_note' if video and video.round_message else DownloadType.ANIMATION
+        if raw.types.DocumentAttributeSticker in attributes:
+            return 'sticker'
+        if video:
+            return 'video_note' if video.round_message else DownloadType.VIDEO
+        audio = attributes.get(raw.types.DocumentAttributeAudio)
+        if audio:
+            return DownloadType.VOICE if audio.voice else DownloadType.AUDIO
+        return DownloadType.DOCUMENT
+
+
+class HistoryPage(list):
+    """一页聊天记录,last_id与size为筛选前的原始结果,使整页都被筛除时仍能继续翻页。"""
+
+    def __init__(self, messages: list, last_id: int = 0, size: int = 0):
+        super().__init__(messages)
+        self.last_id: int = last_id
+        self.size: int = size
+
 
 class TelegramRestrictedMediaDownloaderClient(pyrogram.Client):
 
@@ -282,37 +342,270 @@ class TelegramRestrictedMediaDownloaderClient(pyrogram.Client):
             offset_id: int = 0,
             offset_date: datetime = utils.zero_datetime(),
             reverse: bool = False,
+            prefetch: int = 0,
+            predicate: Optional[Callable[[MessageRecord], bool]] = None
     ) -> Optional[AsyncGenerator["types.Message", None]]:
+        """prefetch大于0时,在消费当前页的同时预先获取之后最多prefetch页。
+        指定predicate时先用精简记录筛选,只为通过筛选的消息构造完整的Message。"""
         # https://github.com/tangyoha/telegram_media_downloader/blob/master/module/get_chat_history_v2.py
         current = 0
         total = limit or (1 << 31) - 1
-        limit = min(100, total)
-
-        while True:
-            messages = await get_chunk(
-                client=self,
-                chat_id=chat_id,
-                limit=limit,
-                offset=offset,
-                min_id=min_id,
-                max_id=max_id + 1 if max_id else 0,
-                from_message_id=offset_id,
-                from_date=offset_date,
-                reverse=reverse,
+        pages = get_pages(
+            client=self,
+            chat_id=chat_id,
+            limit=min(100, total),
+            min_id=min_id,
+            max_id=max_id,
+            offset=offset,
+            offset_id=offset_id,
+            offset_date=offset_date,
+            reverse=reverse,
+            predicate=predicate
+        )
+        if prefetch > 0:
+            pages = read_ahead(pages, prefetch)
+        try:
+            async for messages in pages:
+                for message in messages:
+                    yield message
+
+                    current += 1
+
+                    if current >= total:
+                        return
+        finally:
+            await pages.aclose()
+
+    async def seek_message_id(
+            self: pyrogram.Client,
+            chat_id: Union[int, str],
+            date: float
+    ) -> int:
+        """返回发送时间早于date(时间戳)的最后一条消息的ID,不存在时返回0,结果按频道缓存。"""
+        cache_key: tuple = (chat_id, int(date))
+        message_id: Union[int, None] = SEEK_CACHE.get(cache_key)
+        if message_id is not None:
+            return message_id
+        messages: list = await get_chunk(
+            client=self,
+            chat_id=chat_id,
+            limit=1,
+            from_date=datetime.fromtimestamp(date)
+        )
+        message_id = messages[0].id if messages else 0
+        if date < datetime.now().timestamp():  # 未来的时间点之前还会有新消息,不能缓存。
+            SEEK_CACHE.set(cache_key, message_id)
+        return message_id
+
+    async def seek_id_range(
+            self: pyrogram.Client,
+            chat_id: Union[int, str],
+            start_date: Optional[float] = None,
+            end_date: Optional[float] = None
+    ) -> tuple:
+        """将日期区间换算为消息ID区间(min_id,max_id],max_id为0表示不限制。"""
+        min_id: int = await self.seek_message_id(chat_id, start_date) if start_date else 0
+        max_id: int = await self.seek_message_id(chat_id, end_date + 1) if end_date else 0
+        return min_id, max_id
+
+    async def get_chat_history_sharded(
+            self: pyrogram.Client,
+            chat_id: Union[int, str],
+            min_id: int = 0,
+            max_id: int = 0,
+            shards: int = 4,
+            ordered: bool = True,
+            buffer: int = 4,
+            predicate: Optional[Callable[[MessageRecord], bool]] = None
+    ) -> Optional[AsyncGenerator["types.Message", None]]:
+        """将(min_id,max_id]拆分为shards段并发扫描,ordered为True时按ID升序输出,否则按到达顺序输出。
+        任一段触发FloodWait时所有段一起暂停,predicate与get_chat_history相同。"""
+        bounded: bool = max_id > 0
+        if max_id <= 0:  # 未指定上限时以最新一条消息为准。
+            top: list = await get_chunk(client=self, chat_id=chat_id, limit=1)
+            if not top:
+                return
+            max_id = top[0].id
+        if max_id <= min_id:
+            return
+        # 分段按对齐的固定网格划分,段长取不小于平均长度的2的幂,未指定上限时最后一段也不截断到最新消息,
+        # 这样新消息到来时各段的请求参数不变,分页缓存仍能命中。
+        size: int = 1 << max((-(-(max_id - min_id) // max(shards, 1)) - 1).bit_length(), 7)
+        ranges: list = [
+            (max(block * size + 1, min_id + 1), min((block + 1) * size, max_id) if bounded else (block + 1) * size)
+            for block in range(min_id // size, (max_id - 1) // size + 1)
+        ]
+        loop = asyncio.get_running_loop()
+        resume: dict = {'at': 0.0}
+        end = object()
+        queues: list = [asyncio.Queue(maxsize=max(buffer, 1)) for _ in ranges] if ordered else []
+        merged: asyncio.Queue = asyncio.Queue(maxsize=max(buffer, 1) * len(ranges))
+
+        async def _scan(lo: int, hi: int, out: asyncio.Queue) -> None:
+            offset_id: int = lo
+            try:
+                while offset_id <= hi:
+                    delay: float = resume['at'] - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    try:
+                        page: HistoryPage = await get_chunk(
+                            client=self,
+                            chat_id=chat_id,
+                            limit=100,
+                            min_id=lo - 1,
+                            max_id=hi + 1,
+                            from_message_id=offset_id,
+                            reverse=True,
+                            sleep_threshold=0,
+                            predicate=predicate
+                        )
+                    except FloodWait as e:
+                        resume['at'] = max(resume['at'], loop.time() + e.value)
+                        log.info(f'扫描聊天记录时触发FloodWait,所有分段等待{e.value}秒后继续。')
+                        continue
+                    if not page.size:
+                        break
+                    offset_id = page.last_id + 1
+                    if page:
+                        await out.put(page)
+                await out.put(end)
+            except Exception as e:
+                await out.put(e)
+
+        tasks: list = [
+            asyncio.create_task(_scan(lo, hi, queues[index] if ordered else merged))
+            for index, (lo, hi) in enumerate(ranges)
+        ]
+        try:
+            for out in (queues if ordered else [merged] * len(ranges)):
+                while True:  # 无序模式下每取到一个结束标记代表一段扫描完成。
+                    page = await out.get()
+                    if page is end:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    for message in page:
+                        yield message
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def stream_media_part(
+            self: pyrogram.Client,
+            message: Union["types.Message", str],
+            offset: int = 0,
+            limit: int = 0,
+            chunk_size: int = 1024 * 1024
+    ) -> AsyncGenerator[bytes, None]:
+        """与stream_media相同,但不吞掉请求中的异常,使调用方能处理FILE_REFERENCE_EXPIRED等错误。
+        不支持存放在CDN上的文件,遇到FileCdnRedirect时抛出NotImplementedError。"""
+        if isinstance(message, types.Message):
+            media = next((getattr(message, _) for _ in DownloadType() if getattr(message, _, None)), None)
+            if media is None:
+                raise ValueError('This message doesn\'t contain any downloadable media')
+        else:
+            media = message
+        file_id: FileId = FileId.decode(media if isinstance(media, str) else media.file_id)
+        if file_id.file_type == FileType.PHOTO:
+            location = raw.types.InputPhotoFileLocation(
+                id=file_id.media_id,
+                access_hash=file_id.access_hash,
+                file_reference=file_id.file_reference,
+                thumb_size=file_id.thumbnail_size
             )
-
-            if not messages:
+        else:
+            location = raw.types.InputDocumentFileLocation(
+                id=file_id.media_id,
+                access_hash=file_id.access_hash,
+                file_reference=file_id.file_reference,
+                thumb_size=file_id.thumbnail_size
+            )
+        current: int = 0
+        total: int = limit or (1 << 31) - 1
+        # 调用方按请求持有下载器的分段传输名额(由AIMD按吞吐调整),不再使用max_concurrent_transmissions的固定信号量。
+        session = await self.get_session(file_id.dc_id, is_media=True)
+        while current < total:
+            r = await session.invoke(
+                raw.functions.upload.GetFile(
+                    location=location,
+                    offset=(offset + current) * chunk_size,
+                    limit=chunk_size
+                ),
+                sleep_threshold=0  # FloodWait交给调用方处理,以便据此降低并发。
+            )
+            if isinstance(r, raw.types.upload.FileCdnRedirect):
+                # pyrogram的get_file在CDN数据中心上出错时只记录日志并静默结束,不能作为退路。
+                raise NotImplementedError(f'The file is redirected to CDN DC {r.dc_id}, which is not supported.')
+            yield r.bytes
+            current += 1
+            if len(r.bytes) < chunk_size:
                 return
 
-            offset_id = messages[-1].id + (1 if reverse else 0)
-
-            for message in messages:
-                yield message
 
-                current += 1
-
-                if current >= total:
-                    return
+async def get_pages(
+        *,
+        client: pyrogram.Client,
+        chat_id: Union[int, str],
+        limit: int = 100,
+        min_id: int = 0,
+        max_id: int = 0,
+        offset: int = 0,
+        offset_id: int = 0,
+        offset_date: datetime = utils.zero_datetime(),
+        reverse: bool = False,
+        predicate: Optional[Callable[[MessageRecord], bool]] = None
+) -> AsyncGenerator[List["types.Message"], None]:
+    """逐页获取聊天记录,直到没有更多消息,被predicate筛空的页不输出。"""
+    while True:
+        page: HistoryPage = await get_chunk(
+            client=client,
+            chat_id=chat_id,
+            limit=limit,
+            offset=offset,
+            min_id=min_id,
+            max_id=max_id + 1 if max_id else 0,
+            from_message_id=offset_id,
+            from_date=offset_date,
+            reverse=reverse,
+            predicate=predicate
+        )
+
+        if not page.size:
+            return
+
+        offset_id = page.last_id + (1 if reverse else 0)
+        if page:
+            yield page
+
+
+async def read_ahead(pages: AsyncGenerator, depth: int) -> AsyncGenerator:
+    """在后台任务中提前获取最多depth页,消费方处理当前页时下一页的请求已在进行。"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=depth)
+    end = object()
+
+    async def _produce() -> None:
+        try:
+            async for page in pages:
+                await queue.put(page)
+            await queue.put(end)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(_produce())
+    try:
+        while True:
+            page = await queue.get()
+            if page is end:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await pages.aclose()
 
 
 async def get_chunk(
@@ -325,28 +618,82 @@ async def get_chunk(
         max_id: int = 0,
         from_message_id: int = 0,
         from_date: datetime = utils.zero_datetime(),
-        reverse: bool = False
-):
+        reverse: bool = False,
+        sleep_threshold: int = 60,
+        predicate: Optional[Callable[[MessageRecord], bool]] = None
+) -> HistoryPage:
+    """获取一页聊天记录。指定predicate时直接从原始TL消息生成MessageRecord进行筛选,只解析通过筛选的消息。
+    原始结果、精简记录与解析后的消息都随hash缓存,服务端返回MessagesNotModified时直接复用。"""
     from_message_id = from_message_id or (1 if reverse else 0)
-    messages = await utils.parse_messages(
-        client,
-        await client.invoke(
-            raw.functions.messages.GetHistory(
-                peer=await client.resolve_peer(chat_id),
-                offset_id=from_message_id,
-                offset_date=utils.datetime_to_timestamp(from_date),
-                add_offset=offset * (-1 if reverse else 1) - (limit if reverse else 0),
-                limit=limit,
-                max_id=max_id,
-                min_id=min_id,
-                hash=0,
-            ),
-            sleep_threshold=60,
+    offset_date: int = utils.datetime_to_timestamp(from_date)
+    add_offset: int = offset * (-1 if reverse else 1) - (limit if reverse else 0)
+    cache_key: tuple = (chat_id, from_message_id, offset_date, add_offset, limit, max_id, min_id)
+    entry: Union[dict, None] = PAGE_CACHE.get(cache_key)
+    r = await client.invoke(
+        raw.functions.messages.GetHistory(
+            peer=await client.resolve_peer(chat_id),
+            offset_id=from_message_id,
+            offset_date=offset_date,
+            add_offset=add_offset,
+            limit=limit,
+            max_id=max_id,
+            min_id=min_id,
+            hash=entry.get('hash') if entry else 0,  # 与上次结果相同时服务端只返回MessagesNotModified。
         ),
-        replies=0,
+        sleep_threshold=sleep_threshold,
     )
+    if not (entry and isinstance(r, raw.types.messages.MessagesNotModified)):
+        entry = {
+            'hash': history_hash([message.id for message in r.messages]),
+            'raw': r,
+            'records': None,  # 按需生成的MessageRecord,键为消息ID。
+            'messages': None,  # 按需解析的整页消息。
+            'parsed': {}  # 逐条解析的消息,键为消息ID。
+        }
+        PAGE_CACHE.set(cache_key, entry)
+    r = entry.get('raw')
+    message_ids: list = [message.id for message in r.messages]
+    if predicate:
+        if entry.get('records') is None:
+            entry['records'] = {
+                message.id: MessageRecord(message) for message in r.messages if isinstance(message, raw.types.Message)
+            }
+        kept_ids: set = {message_id for message_id, record in entry.get('records').items() if predicate(record)}
+        parsed: dict = entry.get('parsed')
+        missing: list = [message for message in r.messages if message.id in kept_ids and message.id not in parsed]
+        if missing:
+            for message in await utils.parse_messages(
+                    client,
+                    raw.types.messages.Messages(
+                        messages=missing,
+                        topics=getattr(r, 'topics', []),
+                        chats=r.chats,
+                        users=r.users
+                    ),
+                    replies=0
+            ):
+                parsed[message.id] = message
+        messages = [parsed.get(message.id) for message in r.messages if message.id in kept_ids and message.id in parsed]
+    else:
+        if entry.get('messages') is None:
+            entry['messages'] = await utils.parse_messages(client, r, replies=0)
+            entry.get('parsed').update({message.id: message for message in entry.get('messages')})
+        messages = list(entry.get('messages'))
 
     if reverse:
         messages.reverse()
 
-    return messages
+    # 服务端按ID降序返回,翻页位置取本页最旧(reverse时为最新)的一条。
+    last_id: int = (max(message_ids) if reverse else min(message_ids)) if message_ids else 0
+    return HistoryPage(messages, last_id=last_id, size=len(message_ids))
+
+
+def history_hash(message_ids: List[int]) -> int:
+    """按Telegram的规则计算一组消息ID的hash(64位有符号整数)。"""
+    value: int = 0
+    for message_id in message_ids:
+        value ^= value >> 21
+        value ^= (value << 35) & 0xFFFFFFFFFFFFFFFF
+        value ^= value >> 4
+        value = (value + message_id) & 0xFFFFFFFFFFFFFFFF
+    return value - (1 << 64) if value >= 1 << 63 else value
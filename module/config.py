@@ -578,6 +578,26 @@ class GlobalConfig(BaseConfig):
                 'download_upload': True,
                 'delete': False
             },
+        'download':
+            {
+                'parallel_part': 4,
+                'parallel_threshold': 64,
+                'write_queue': 16,
+                'preallocate': False,
+                'chunk_retries': 5,
+                'chunk_timeout': 60,
+                'adaptive': True,
+                'small_file_size': 10,
+                'small_file_task': 4,
+                'resolve_worker': 2,
+                'finalize_worker': 2,
+                'post_worker': 2,
+                'history_prefetch': 2,
+                'history_shard': 4,
+                'dedupe': True,
+                'content_store': False,
+                'direct_write': True
+            },
         'forward_type':
             {
                 'video': True,
@@ -594,6 +614,7 @@ class GlobalConfig(BaseConfig):
         super().__init__()
         self.default_upload_nesting = self.TEMPLATE.get('upload')
         self.default_forward_type_nesting = self.TEMPLATE.get('forward_type')
+        self.default_download_nesting = self.TEMPLATE.get('download')
         self.load_config()
         self.__check_params(self.config.copy())
         self.download_upload: bool = self.get_nesting_config(
@@ -611,6 +632,15 @@ class GlobalConfig(BaseConfig):
     def get_nesting_config(self, default_nesting, param, nesting_param):
         return self.config.get(param, default_nesting).get(nesting_param)
 
+    def get_download_config(self, nesting_param):
+        """获取下载相关的配置参数,缺失时使用模板中的默认值。"""
+        value = self.get_nesting_config(
+            default_nesting=self.default_download_nesting,
+            param='download',
+            nesting_param=nesting_param
+        )
+        return self.default_download_nesting.get(nesting_param) if value is None else value
+
     def save_config(self, config: dict) -> None:
         super().save_config(config)
         self.download_upload = self.get_nesting_config(
@@ -639,6 +669,7 @@ class GlobalConfig(BaseConfig):
             log_message='"{}"不在全局配置文件中,已添加。'
         )
         self.process_nesting(param_name='export_table', config=config)
+        self.process_nesting(param_name='download', config=config)
         # 删除父级模板中没有的字段。
         self.remove_extra_keys(
             target=config,
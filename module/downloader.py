@@ -5,15 +5,20 @@
 # File:downloader.py
 import os
 import sys
+import json
+import math
+import hashlib
 import asyncio
 import datetime
 
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from sqlite3 import OperationalError
 from typing import Union, Callable, Optional, Dict
 
 import pyrogram
 from pyrogram.enums.parse_mode import ParseMode
+from pyrogram.enums.messages_filter import MessagesFilter
 from pyrogram.errors.exceptions.bad_request_400 import (
     MsgIdInvalid,
     UsernameInvalid,
@@ -22,7 +27,8 @@ from pyrogram.errors.exceptions.bad_request_400 import (
     UsernameNotOccupied,
     PeerIdInvalid,
     ChannelPrivate as ChannelPrivate_400,
-    ChatForwardsRestricted as ChatForwardsRestricted_400
+    ChatForwardsRestricted as ChatForwardsRestricted_400,
+    FileReferenceExpired
 )
 from pyrogram.errors.exceptions.not_acceptable_406 import (
     ChannelPrivate as ChannelPrivate_406,
@@ -35,6 +41,7 @@ from pyrogram.errors.exceptions.unauthorized_401 import (
     Unauthorized
 )
 from pyrogram.errors.exceptions.forbidden_403 import ChatWriteForbidden
+from pyrogram.errors.exceptions.flood_420 import FloodWait
 from pyrogram.handlers import MessageHandler
 from pyrogram.types.messages_and_media import ReplyParameters
 from pyrogram.types.bots_and_keyboards import (
@@ -60,7 +67,8 @@ from module.enums import (
     BotMessage,
     DownloadType,
     CalenderKeyboard,
-    SaveDirectoryPrefix
+    SaveDirectoryPrefix,
+    TaskPriority
 )
 from module.language import _t
 from module.path_tool import (
@@ -70,15 +78,26 @@ from module.path_tool import (
     split_path,
     compare_file_size,
     move_to_save_directory,
-    safe_replace
+    safe_replace,
+    preallocate_file,
+    link_file,
+    move_to_content_store
 )
 from module.task import DownloadTask
 from module.stdio import ProgressBar, Base64Image, MetaData
 from module.uploader import TelegramUploader
+from module.writer import ChunkWriter
+from module.manifest import PartManifest
+from module.scheduler import TaskScheduler, AdaptiveConcurrency
+from module.pipeline import Stage, Pipeline
+from module.ledger import Ledger, Watermark
 from module.util import (
     parse_link,
     format_chat_link,
     get_message_by_link,
+    prefetch_messages,
+    refresh_message,
+    PREFETCH_BATCH,
     get_chat_with_notify,
     safe_message,
     truncate_display_filename,
@@ -91,9 +110,36 @@ class TelegramRestrictedMediaDownloader(Bot):
     def __init__(self):
         super().__init__()
         self.loop = asyncio.get_event_loop()
-        self.event = asyncio.Event()
         self.queue = asyncio.Queue()
         self.app = Application()
+        self.scheduler = TaskScheduler(limit=self.app.max_download_task)
+        self.small_scheduler: Union[TaskScheduler, None] = TaskScheduler(
+            limit=self.gc.get_download_config('small_file_task')
+        ) if self.gc.get_download_config('small_file_task') > 0 else None  # 小文件单独排队,不被大文件占满名额。
+        self.streams = TaskScheduler(
+            limit=self.app.max_download_task * max(self.gc.get_download_config('parallel_part') or 1, 1)
+        )  # 大小文件两个队列共享的分段传输名额,即同时进行的GetFile请求数上限。
+        self.concurrency: Union[AdaptiveConcurrency, None] = AdaptiveConcurrency(
+            scheduler=self.streams,
+            ceiling=self.streams.limit
+        ) if self.gc.get_download_config('adaptive') else None
+        self.finalize_executor = ThreadPoolExecutor(
+            max_workers=self.gc.get_download_config('finalize_worker'),
+            thread_name_prefix='finalize'
+        )  # 移动与复制文件专用的线程,跨磁盘复制大文件时不占用默认线程池。
+        self.ledger = Ledger()
+        self.watermarks: Dict[int, Watermark] = {}  # 正在同步的聊天,键为聊天ID。
+        self.save_paths: Dict[str, int] = {}  # 正在下载的文件的保存路径及其任务数,被占用的路径不会直接写入。
+        self.__same_device: Dict[str, bool] = {}  # 保存目录是否与临时目录位于同一设备。
+        self.pipeline = Pipeline(
+            Stage(
+                name='resolve',
+                handler=lambda link: self.create_download_task(message_ids=link, retry=None),
+                workers=self.gc.get_download_config('resolve_worker')
+            ),
+            Stage(name='finalize', handler=self.__finalize, workers=self.gc.get_download_config('finalize_worker')),
+            Stage(name='post', handler=self.__post_process, workers=self.gc.get_download_config('post_worker'))
+        )  # 解析->准入(调度器)->传输->整理->后处理,各阶段以有界队列相连。
         self.is_running: bool = False
         self.running_log: set = set()
         self.running_log.add(self.is_running)
@@ -135,7 +181,7 @@ class TelegramRestrictedMediaDownloader(Bot):
         invalid_link: set = link_meta.get('invalid_link')
         last_bot_message: Union[pyrogram.types.Message, None] = link_meta.get('last_bot_message')
         exist_link: set = set([_ for _ in right_link if _ in self.bot_task_link])
-        exist_link.update(right_link & DownloadTask.COMPLETE_LINK)
+        exist_link.update(self.ledger.get_complete_links(right_link))
         right_link -= exist_link
         if last_bot_message:
             await self.safe_edit_message(
@@ -154,11 +200,13 @@ class TelegramRestrictedMediaDownloader(Bot):
 
         if links is None:
             return None
+        await prefetch_messages(client=self.app.client, links=list(links))
         for link in links:
             task: dict = await self.create_download_task(
                 message_ids=link,
                 retry=None,
-                with_upload=with_upload
+                with_upload=with_upload,
+                priority=TaskPriority.INTERACTIVE
             )
             invalid_link.add(link) if task.get('status') == DownloadStatus.FAILURE else self.bot_task_link.add(link)
         right_link -= invalid_link
@@ -188,7 +236,8 @@ class TelegramRestrictedMediaDownloader(Bot):
         try:
             await self.uploader.create_upload_task(
                 link=target_link,
-                file_path=file_path
+                file_path=file_path,
+                priority=TaskPriority.INTERACTIVE
             )
         except ValueError:
             await client.send_message(
@@ -905,11 +954,10 @@ class TelegramRestrictedMediaDownloader(Bot):
                 link_preview_options=LINK_PREVIEW_OPTIONS,
                 text=loading
             )
-            async for i in self.app.client.get_chat_history(
+            async for i in self.get_history(
                     chat_id=origin_chat.id,
-                    offset_id=start_id,
-                    max_id=end_id,
-                    reverse=True
+                    min_id=max(start_id - 1, 0),
+                    max_id=end_id
             ):
                 try:
                     message_id = i.id
@@ -1175,7 +1223,11 @@ class TelegramRestrictedMediaDownloader(Bot):
             message: pyrogram.types.Message
     ):
         try:
-            await self.create_download_task(message_ids=message.link, single_link=True)
+            await self.create_download_task(
+                message_ids=message.link,
+                single_link=True,
+                priority=TaskPriority.LISTEN
+            )
         except Exception as e:
             log.exception(f'监听下载出现错误,{_t(KeyWord.REASON)}:{e}')
 
@@ -1284,10 +1336,14 @@ class TelegramRestrictedMediaDownloader(Bot):
             progress: Callable = None,
             progress_args: tuple = (),
             chunk_size: int = 1024 * 1024,
-            compare_size: Union[int, None] = None  # 不为None时,将通过大小比对判断是否为完整文件。
+            compare_size: Union[int, None] = None,  # 不为None时,将通过大小比对判断是否为完整文件。
+            fallback_path: Union[str, None] = None  # 直接写入保存目录而保存路径已被占用时,改为移动到该路径。
     ) -> str:
-        temp_path = f'{file_name}.temp'
-        if os.path.exists(file_name) and compare_size:
+        temp_path: str = self.get_partial_path(file_name)
+        direct: bool = self.is_direct(file_name)
+        media = next((getattr(message, _) for _ in DownloadType() if getattr(message, _, None)), None)
+        file_size: int = compare_size or getattr(media, 'file_size', 0)
+        if os.path.exists(file_name) and compare_size and not direct:  # 保存路径中已有的文件可能属于其他任务,不能接管。
             local_file_size: int = get_file_size(file_path=file_name)
             if compare_file_size(a_size=local_file_size, b_size=compare_size):
                 console.log(
@@ -1303,41 +1359,260 @@ class TelegramRestrictedMediaDownloader(Bot):
                     f'更改文件名作为缓存:[{file_name}]({get_file_size(file_name)}) -> [{temp_path}]({compare_size})。')
         if os.path.exists(temp_path) and compare_size:
             local_file_size: int = get_file_size(file_path=temp_path)
-            if compare_file_size(a_size=local_file_size, b_size=compare_size):
-                console.log(
-                    f'{_t(KeyWord.DOWNLOAD_TASK)}'
-                    f'{_t(KeyWord.RESUME)}:"{temp_path}",'
-                    f'{_t(KeyWord.STATUS)}:{_t(KeyWord.ALREADY_EXIST)}')
-                result: str = safe_replace(origin_file=temp_path, overwrite_file=file_name).get('e_code')
-                log.warning(result) if result is not None else None
-                return file_name
-            elif local_file_size > compare_size:
+            if local_file_size > compare_size:
                 safe_delete(temp_path)
                 log.warning(
                     f'错误的缓存文件"{temp_path}",'
                     f'已清除({_t(KeyWord.ERROR_SIZE)}:{local_file_size} > {_t(KeyWord.ACTUAL_SIZE)}:{compare_size})。')
-        downloaded = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0  # 获取已下载的字节数。
-        if downloaded == 0:
-            mode = 'wb'
-        else:
-            mode = 'ab'
+        manifest = PartManifest.load(
+            temp_path=temp_path,
+            file_size=file_size,
+            file_unique_id=getattr(media, 'file_unique_id', None),
+            chunk_size=chunk_size
+        )
+        downloaded: int = manifest.completed_size()  # 以清单中已完成的块计算已下载的字节数。
+        if os.path.exists(temp_path) and manifest.is_complete():
+            console.log(
+                f'{_t(KeyWord.DOWNLOAD_TASK)}'
+                f'{_t(KeyWord.RESUME)}:"{temp_path}",'
+                f'{_t(KeyWord.STATUS)}:{_t(KeyWord.ALREADY_EXIST)}')
+        elif downloaded != 0:
             console.log(
                 f'{_t(KeyWord.DOWNLOAD_TASK)}'
                 f'{_t(KeyWord.RESUME)}:"{file_name}",'
                 f'{_t(KeyWord.ERROR_SIZE)}:{MetaData.suitable_units_display(downloaded)}。')
-        with open(file=temp_path, mode=mode) as f:
-            skip_chunks: int = downloaded // chunk_size  # 计算要跳过的块数。
-            async for chunk in self.app.client.stream_media(message=message, offset=skip_chunks):
-                f.write(chunk)
-                downloaded += len(chunk)
-                progress(downloaded, *progress_args)
-        if compare_size is None or compare_file_size(a_size=downloaded, b_size=compare_size):
-            result: str = safe_replace(origin_file=temp_path, overwrite_file=file_name).get('e_code')
+        part_num: int = 1
+        parallel_threshold: int = (self.gc.get_download_config('parallel_threshold') or 0) * 1024 * 1024
+        if file_size >= parallel_threshold:
+            part_num = max(self.gc.get_download_config('parallel_part') or 1, 1)
+        if not manifest.is_complete():
+            if self.gc.get_download_config('preallocate') and manifest.persistent:
+                manifest.save()  # 先落盘清单,避免预分配后的文件因缺少清单而被误判为已完成。
+                if not await self.loop.run_in_executor(None, preallocate_file, temp_path, file_size):
+                    log.info(f'预分配"{temp_path}"失败,将按需增长文件。')
+            await self.__download_parts(
+                message=message,
+                temp_path=temp_path,
+                manifest=manifest,
+                part_num=part_num,
+                progress=progress,
+                progress_args=progress_args
+            )
+        if manifest.is_complete():
+            result: str = safe_replace(origin_file=temp_path, overwrite_file=file_name, overwrite=not direct).get('e_code')
+            if result is not None and direct and fallback_path and os.path.isfile(temp_path):
+                log.warning(f'{result}已改为保存到"{fallback_path}"。')
+                file_name = fallback_path
+                result = safe_replace(origin_file=temp_path, overwrite_file=file_name).get('e_code')
             log.warning(result) if result is not None else None
+            manifest.delete()
             log.info(
                 f'"{temp_path}"下载完成,更改文件名:[{temp_path}]({get_file_size(temp_path)}) -> [{file_name}]({compare_size})')
         return file_name
 
+    async def __download_parts(
+            self,
+            message: pyrogram.types.Message,
+            temp_path: str,
+            manifest: PartManifest,
+            part_num: int,
+            progress: Callable,
+            progress_args: tuple
+    ) -> int:
+        """按清单中缺失的块拆分为多段并发下载,每段直接写入临时文件的对应偏移处,返回已完成的字节数。"""
+        chunk_size: int = manifest.chunk_size
+        missing: list = manifest.missing()
+        per_part: int = max(math.ceil(sum(count for _, count in missing) / part_num), 1)
+        parts: list = []
+        for start, count in missing:  # 过长的缺失区间再拆分,使各段的大小大致相同。
+            parts.extend((i, min(per_part, start + count - i)) for i in range(start, start + count, per_part))
+        base: int = manifest.completed_size()
+        completed: dict = {offset: 0 for offset, _ in parts}
+        semaphore = asyncio.Semaphore(part_num)
+        writer = ChunkWriter(
+            file_path=temp_path,
+            max_queue=self.gc.get_download_config('write_queue'),
+            loop=self.loop,
+            manifest=manifest
+        )
+
+        chunk_retries: int = self.gc.get_download_config('chunk_retries')
+        chunk_timeout: int = self.gc.get_download_config('chunk_timeout')
+
+        ref: dict = {'message': message, 'version': 0}  # 各段共享的消息,文件引用过期时只刷新一次。
+        ref_lock = asyncio.Lock()
+
+        async def _refresh(_version: int) -> None:
+            async with ref_lock:
+                if ref['version'] != _version:  # 其他段已刷新过。
+                    return None
+                ref['message'] = await refresh_message(client=self.app.client, message=ref['message'])
+                ref['version'] += 1
+
+        async def _fetch(_offset: int, _limit: int) -> None:
+            _expect: int = min((_offset + _limit) * chunk_size, manifest.file_size) - _offset * chunk_size
+            _retry: int = 0
+            _refreshed: bool = False  # 自上次刷新后尚无进展,再次过期则按普通错误重试。
+            async with semaphore:
+                while True:
+                    _error: Union[Exception, None] = None
+                    _done_chunk: int = completed[_offset] // chunk_size
+                    _version: int = ref['version']
+                    await self.streams.acquire(key=temp_path)  # 各文件公平地分配传输名额,等待重试期间不占用。
+                    _stream = self.app.client.stream_media_part(
+                        message=ref['message'],
+                        offset=_offset + _done_chunk,
+                        limit=_limit - _done_chunk,
+                        chunk_size=chunk_size
+                    )
+                    try:
+                        while True:  # 为每个块单独设置超时,避免卡住的请求拖住整段。
+                            _chunk: bytes = await asyncio.wait_for(_stream.__anext__(), timeout=chunk_timeout)
+                            await writer.write(_offset * chunk_size + completed[_offset], _chunk)
+                            completed[_offset] += len(_chunk)
+                            self.concurrency.feed(len(_chunk)) if self.concurrency else None
+                            progress(base + sum(completed.values()), *progress_args)
+                            _retry = 0
+                            _refreshed = False
+                    except StopAsyncIteration:
+                        pass
+                    except FloodWait as e:
+                        log.info(f'下载"{temp_path}"时触发FloodWait,等待{e.value}秒后继续。')
+                        self.concurrency.penalize('触发FloodWait') if self.concurrency else None
+                        await asyncio.sleep(e.value)
+                        continue
+                    except FileReferenceExpired as e:
+                        if not _refreshed:
+                            log.info(f'下载"{temp_path}"时文件引用已过期,刷新后从块{_offset + completed[_offset] // chunk_size}继续。')
+                            await _refresh(_version)
+                            _refreshed = True
+                            continue
+                        _error = e
+                    except NotImplementedError:  # 不支持的文件(如CDN文件),重试也无法完成。
+                        raise
+                    except Exception as e:
+                        if writer.error:
+                            raise writer.error
+                        if isinstance(e, asyncio.TimeoutError) and self.concurrency:
+                            self.concurrency.penalize('传输卡住')
+                        _error = e
+                    finally:
+                        await _stream.aclose()
+                        self.streams.release()
+                    if completed[_offset] >= _expect:
+                        return None
+                    # stream_media在出错时可能静默结束,同样视为该块失败,从当前块起重试。
+                    if _retry >= chunk_retries:
+                        raise _error or ConnectionError(f'块{_offset + completed[_offset] // chunk_size}重试次数已耗尽。')
+                    _retry += 1
+                    _delay: int = min(2 ** _retry, 60)
+                    log.info(
+                        f'下载"{temp_path}"的块{_offset + completed[_offset] // chunk_size}失败,'
+                        f'{_delay}秒后重试({_retry}/{chunk_retries}),{_t(KeyWord.REASON)}:"{_error}"')
+                    await asyncio.sleep(_delay)
+
+        try:
+            results: list = await asyncio.gather(*[_fetch(offset, limit) for offset, limit in parts],
+                                                 return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    log.warning(f'下载"{temp_path}"时出错,{_t(KeyWord.REASON)}:"{result}"')
+        finally:
+            try:
+                await writer.close()
+            except OSError as e:
+                log.error(f'写入"{temp_path}"时出错,{_t(KeyWord.REASON)}:"{e}"')
+        return manifest.completed_size()
+
+    def get_history(
+            self,
+            chat_id: Union[int, str],
+            min_id: int = 0,
+            max_id: int = 0,
+            ordered: bool = True,
+            predicate: Optional[Callable] = None
+    ):
+        """按ID升序遍历(min_id,max_id]内的聊天记录,history_shard大于1时分段并发扫描。
+        predicate接收由原始消息生成的精简记录,只有返回True的消息才会构造为完整的Message。"""
+        shards: int = self.gc.get_download_config('history_shard')
+        prefetch: int = self.gc.get_download_config('history_prefetch')
+        if shards > 1:
+            return self.app.client.get_chat_history_sharded(
+                chat_id=chat_id,
+                min_id=min_id,
+                max_id=max_id,
+                shards=shards,
+                ordered=ordered,
+                buffer=max(prefetch, 1),
+                predicate=predicate
+            )
+        return self.app.client.get_chat_history(
+            chat_id=chat_id,
+            offset_id=min_id + 1 if min_id else 0,
+            max_id=max_id,
+            reverse=True,
+            prefetch=prefetch,
+            predicate=predicate
+        )
+
+    def blob_path(self, file_unique_id: str, file_path: str) -> str:
+        """按内容保存时文件的实际路径,位于保存目录中第一个占位符之前的.blobs目录下,以file_unique_id的摘要命名。"""
+        root: str = self.app.save_directory
+        index: int = min((root.find(_) for _ in SaveDirectoryPrefix() if _ in root), default=-1)
+        root = os.path.dirname(root[:index]) if index >= 0 else root
+        digest: str = hashlib.sha1(file_unique_id.encode()).hexdigest()  # 不区分大小写的文件系统上也不会冲突。
+        return os.path.join(root, '.blobs', digest[:2], f'{digest}{os.path.splitext(file_path)[1]}')
+
+    def is_direct(self, file_path: str) -> bool:
+        """文件是否直接下载到保存目录(不在临时目录中)。"""
+        temp_directory: str = os.path.abspath(self.app.temp_directory)
+        try:
+            return os.path.commonpath([os.path.abspath(file_path), temp_directory]) != temp_directory
+        except ValueError:  # 位于不同的驱动器。
+            return True
+
+    def get_partial_path(self, file_path: str) -> str:
+        """下载未完成时写入的文件路径,直接写入保存目录时使用以.开头的隐藏文件,避免未完成的文件被当作已下载。"""
+        if not self.is_direct(file_path):
+            return f'{file_path}.temp'
+        directory, file_name = split_path(file_path).values()
+        return os.path.join(directory, f'.{file_name}.temp')
+
+    def __direct_path(self, temp_file_path: str, save_directory: str) -> str:
+        """为任务占用保存路径,保存目录与临时目录位于同一设备时,直接下载到保存目录,完成时只需一次原子重命名。
+        保存路径已有文件、正被其他任务(无论是否直接写入)占用或临时目录中已有未完成的下载时,仍使用临时目录。
+        占用的路径在任务结束时通过__release_path归还。"""
+        occupied: int = self.save_paths.get(save_directory, 0)
+        self.save_paths[save_directory] = occupied + 1
+        if not self.gc.get_download_config('direct_write') or self.gc.get_download_config('content_store'):
+            return temp_file_path
+        if occupied or any(
+                os.path.exists(_) for _ in (save_directory, temp_file_path, self.get_partial_path(temp_file_path))
+        ):
+            return temp_file_path
+        directory: str = split_path(save_directory).get('directory')
+        if directory not in self.__same_device:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                self.__same_device[directory] = os.stat(directory).st_dev == os.stat(self.app.temp_directory).st_dev
+            except OSError:
+                self.__same_device[directory] = False
+        if not self.__same_device.get(directory):
+            return temp_file_path
+        return save_directory
+
+    def __release_path(self, save_directory: str) -> None:
+        """任务结束,归还__direct_path占用的保存路径。"""
+        occupied: int = self.save_paths.pop(save_directory, 0) - 1
+        if occupied > 0:
+            self.save_paths[save_directory] = occupied
+
+    def get_lane(self, file_size: int) -> TaskScheduler:
+        """按文件大小选择下载队列,不超过small_file_size(MiB)的文件进入小文件队列。"""
+        if self.small_scheduler and file_size <= self.gc.get_download_config('small_file_size') * 1024 * 1024:
+            return self.small_scheduler
+        return self.scheduler
+
     def get_media_meta(self, message: pyrogram.types.Message, dtype) -> Dict[str, Union[int, str]]:
         """获取媒体元数据。"""
         file_id: int = getattr(message, 'id')
@@ -1364,7 +1639,8 @@ class TelegramRestrictedMediaDownloader(Bot):
             message: Union[pyrogram.types.Message, list],
             retry: dict,
             with_upload: Union[dict, None] = None,
-            diy_download_type: Optional[list] = None
+            diy_download_type: Optional[list] = None,
+            priority: int = TaskPriority.BULK
     ) -> None:
         retry_count = retry.get('count')
         retry_id = retry.get('id')
@@ -1372,12 +1648,15 @@ class TelegramRestrictedMediaDownloader(Bot):
             for _message in message:
                 if retry_count != 0:
                     if _message.id == retry_id:
-                        await self.__add_task(chat_id, link_type, link, _message, retry, with_upload, diy_download_type)
+                        await self.__add_task(
+                            chat_id, link_type, link, _message, retry, with_upload, diy_download_type, priority
+                        )
                         break
                 else:
-                    await self.__add_task(chat_id, link_type, link, _message, retry, with_upload, diy_download_type)
+                    await self.__add_task(
+                        chat_id, link_type, link, _message, retry, with_upload, diy_download_type, priority
+                    )
         else:
-            _task = None
             valid_dtype: str = next((_ for _ in DownloadType() if getattr(message, _, None)), None)  # 判断该链接是否为有支持的类型。
             download_type: list = diy_download_type if diy_download_type else self.app.download_type
             if valid_dtype in download_type:
@@ -1388,18 +1667,98 @@ class TelegramRestrictedMediaDownloader(Bot):
                     f'{_t(KeyWord.LINK)}:"{link}",'  # 链接。
                     f'{_t(KeyWord.LINK_TYPE)}:{_t(link_type)}。'  # 链接类型。
                 )
-                while self.app.current_task_num >= self.app.max_download_task:  # v1.0.7 增加下载任务数限制。
-                    await self.event.wait()
-                    self.event.clear()
                 file_id, temp_file_path, sever_file_size, file_name, save_directory, format_file_size = \
                     self.get_media_meta(
                         message=message,
                         dtype=valid_dtype).values()
                 retry['id'] = file_id
-                if is_file_duplicate(
+                fallback_path: str = temp_file_path
+                temp_file_path = self.__direct_path(temp_file_path, save_directory)
+                self.queue.put_nowait(self.loop.create_task(self.__admit(
+                    chat_id=chat_id,
+                    link=link,
+                    message=message,
+                    retry_count=retry_count,
+                    with_upload=with_upload,
+                    diy_download_type=diy_download_type,
+                    priority=priority,
+                    valid_dtype=valid_dtype,
+                    file_id=file_id,
+                    temp_file_path=temp_file_path,
+                    fallback_path=fallback_path,
+                    sever_file_size=sever_file_size,
+                    file_name=file_name,
+                    save_directory=save_directory,
+                    format_file_size=format_file_size
+                )))  # 在独立任务中等待名额,解析阶段不会被占满的队列阻塞。
+            else:
+                _error = '不支持或被忽略的类型(已取消)。'
+                try:
+                    _, __, ___, file_name, ____, format_file_size = self.get_media_meta(
+                        message=message,
+                        dtype=valid_dtype
+                    ).values()
+                    if file_name:
+                        console.log(
+                            f'{_t(KeyWord.DOWNLOAD_TASK)}'
+                            f'{_t(KeyWord.FILE)}:"{file_name}",'
+                            f'{_t(KeyWord.SIZE)}:{format_file_size},'
+                            f'{_t(KeyWord.TYPE)}:{_t(self.app.get_file_type(message, file_name, DownloadStatus.SKIP))},'
+                            f'{_t(KeyWord.STATUS)}:{_t(DownloadStatus.SKIP)}。'
+                        )
+                        DownloadTask.set_error(link=link, key=file_name, value=_error.replace('。', ''))
+                    else:
+                        raise Exception('不支持或被忽略的类型。')
+                except Exception as _:
+                    DownloadTask.set_error(link=link, value=_error.replace('。', ''))
+                    console.log(
+                        f'{_t(KeyWord.DOWNLOAD_TASK)}'
+                        f'{_t(KeyWord.CHANNEL)}:"{chat_id}",'  # 频道名。
+                        f'{_t(KeyWord.LINK)}:"{link}",'  # 链接。
+                        f'{_t(KeyWord.LINK_TYPE)}:{_error}'  # 链接类型。
+                    )
+                self.__settle(message)
+
+    async def __admit(
+            self,
+            chat_id: Union[str, int],
+            link: str,
+            message: pyrogram.types.Message,
+            retry_count: int,
+            with_upload: Union[dict, None],
+            diy_download_type: Optional[list],
+            priority: int,
+            valid_dtype: str,
+            file_id: int,
+            temp_file_path: str,
+            fallback_path: str,
+            sever_file_size: int,
+            file_name: str,
+            save_directory: str,
+            format_file_size: str
+    ) -> None:
+        """准入阶段:按优先级及聊天公平地等待下载名额,获得名额后检测是否已下载,否则创建传输任务。"""
+        _task = None
+        lane: TaskScheduler = self.get_lane(sever_file_size)
+        try:
+            await lane.acquire(priority=priority, key=chat_id)
+            try:
+                if retry_count != 0:  # 链接解析结果来自缓存,重试时只刷新该消息的file_reference。
+                    message = await refresh_message(client=self.app.client, message=message)
+                exist_path: Union[str, None] = self.__lookup_download(
+                    message=message,
+                    dtype=valid_dtype,
+                    save_directory=save_directory,
+                    sever_file_size=sever_file_size
+                )
+                if not exist_path and self.gc.get_download_config('dedupe'):
+                    exist_path = await self.__reuse_download(
+                        message=message,
+                        dtype=valid_dtype,
                         save_directory=save_directory,
                         sever_file_size=sever_file_size
-                ):  # 检测是否存在。
+                    )
+                if exist_path:  # 检测是否已下载。
                     self.download_complete_callback(
                         sever_file_size=sever_file_size,
                         temp_file_path=temp_file_path,
@@ -1412,7 +1771,8 @@ class TelegramRestrictedMediaDownloader(Bot):
                         task_id=None,
                         with_upload=with_upload,
                         diy_download_type=diy_download_type,
-                        _future=save_directory
+                        priority=priority,
+                        _future=exist_path
                     )
                 else:
                     console.log(
@@ -1429,9 +1789,26 @@ class TelegramRestrictedMediaDownloader(Bot):
                         total=sever_file_size
                     )
                     _task = self.loop.create_task(
-                        self.resume_download(
+                        self.__transfer(
+                            lane=lane,
+                            complete=partial(
+                                self.download_complete_callback,
+                                sever_file_size=sever_file_size,
+                                temp_file_path=temp_file_path,
+                                link=link,
+                                message=message,
+                                file_name=file_name,
+                                retry_count=retry_count,
+                                file_id=file_id,
+                                format_file_size=format_file_size,
+                                task_id=task_id,
+                                with_upload=with_upload,
+                                diy_download_type=diy_download_type,
+                                priority=priority
+                            ),
                             message=message,
                             file_name=temp_file_path,
+                            fallback_path=fallback_path,
                             progress=self.pb.bar,
                             progress_args=(
                                 sever_file_size,
@@ -1445,72 +1822,84 @@ class TelegramRestrictedMediaDownloader(Bot):
                         prompt=_t(KeyWord.CURRENT_DOWNLOAD_TASK),
                         num=self.app.current_task_num
                     )
-                    _task.add_done_callback(
-                        partial(
-                            self.download_complete_callback,
-                            sever_file_size,
-                            temp_file_path,
-                            link,
-                            message,
-                            file_name,
-                            retry_count,
-                            file_id,
-                            format_file_size,
-                            task_id,
-                            with_upload,
-                            diy_download_type
-                        )
-                    )
-            else:
-                _error = '不支持或被忽略的类型(已取消)。'
-                try:
-                    _, __, ___, file_name, ____, format_file_size = self.get_media_meta(
-                        message=message,
-                        dtype=valid_dtype
-                    ).values()
-                    if file_name:
-                        console.log(
-                            f'{_t(KeyWord.DOWNLOAD_TASK)}'
-                            f'{_t(KeyWord.FILE)}:"{file_name}",'
-                            f'{_t(KeyWord.SIZE)}:{format_file_size},'
-                            f'{_t(KeyWord.TYPE)}:{_t(self.app.get_file_type(message, file_name, DownloadStatus.SKIP))},'
-                            f'{_t(KeyWord.STATUS)}:{_t(DownloadStatus.SKIP)}。'
-                        )
-                        DownloadTask.set_error(link=link, key=file_name, value=_error.replace('。', ''))
-                    else:
-                        raise Exception('不支持或被忽略的类型。')
-                except Exception as _:
-                    DownloadTask.set_error(link=link, value=_error.replace('。', ''))
-                    console.log(
-                        f'{_t(KeyWord.DOWNLOAD_TASK)}'
-                        f'{_t(KeyWord.CHANNEL)}:"{chat_id}",'  # 频道名。
-                        f'{_t(KeyWord.LINK)}:"{link}",'  # 链接。
-                        f'{_t(KeyWord.LINK_TYPE)}:{_error}'  # 链接类型。
-                    )
+            finally:
+                if _task is None:  # 已存在或出错时没有创建下载,立即归还名额。
+                    lane.release()
             self.queue.put_nowait(_task) if _task else None
+        except Exception as e:
+            DownloadTask.set_error(link=link, key=file_name, value=str(e))
+            self.bot_task_link.discard(link)
+            self.__settle(message, failed=True)
+            log.error(
+                f'{_t(KeyWord.DOWNLOAD_TASK)}'
+                f'{_t(KeyWord.FILE)}:"{file_name}",'
+                f'{_t(KeyWord.STATUS)}:{_t(DownloadStatus.FAILURE)},'
+                f'{_t(KeyWord.REASON)}:"{e}"'
+            )
+        finally:
+            if _task is None:
+                self.__release_path(save_directory)
+            self.queue.task_done()  # 对应__add_task中放入队列的本任务。
 
-    def __check_download_finish(
+    async def __check_download_finish(
             self,
             message: pyrogram.types.Message,
             sever_file_size: int,
             temp_file_path: str,
             save_directory: str,
-            with_move: bool = True
-    ) -> bool:
-        """检测文件是否下完。"""
+            with_move: bool = True,
+            with_store: bool = True
+    ) -> Union[str, bool]:
+        """检测文件是否下完,完成时返回文件最终所在的路径,否则返回False。
+        with_store为False时不按内容保存,用于上传后即删除的文件,避免删除视图后blob无人引用而一直占用空间。"""
         temp_ext: str = '.temp'
-        local_file_size: int = get_file_size(file_path=temp_file_path, temp_ext=temp_ext)
+        partial_path: str = self.get_partial_path(temp_file_path)
+        is_renamed: bool = os.path.isfile(temp_file_path)  # 分块清单确认所有块完成后,临时文件才会被重命名。
+        local_file_size: int = get_file_size(file_path=temp_file_path if is_renamed else partial_path, temp_ext='')
+        if not is_renamed:  # 临时文件可能已被预分配,以清单中已完成的大小为准。
+            completed_size: Union[int, None] = PartManifest.peek(partial_path)
+            local_file_size = local_file_size if completed_size is None else completed_size
+        if os.path.abspath(split_path(temp_file_path).get('directory')) == os.path.abspath(save_directory):
+            with_move = False  # 已直接下载到保存目录。
         format_local_size: str = MetaData.suitable_units_display(local_file_size)
         format_sever_size: str = MetaData.suitable_units_display(sever_file_size)
         _file_path: str = os.path.join(save_directory, split_path(temp_file_path).get('file_name'))
         file_path: str = _file_path[:-len(temp_ext)] if _file_path.endswith(temp_ext) else _file_path
-        if compare_file_size(a_size=local_file_size, b_size=sever_file_size):
-            if with_move:
-                result: str = move_to_save_directory(
-                    temp_file_path=temp_file_path,
-                    save_directory=save_directory
-                ).get('e_code')
+        if is_renamed and compare_file_size(a_size=local_file_size, b_size=sever_file_size):
+            file_unique_id: Union[str, None] = getattr(
+                next((getattr(message, _) for _ in DownloadType() if getattr(message, _, None)), None),
+                'file_unique_id',
+                None
+            )
+            if with_move and with_store and self.gc.get_download_config('content_store') and file_unique_id:
+                result: dict = await self.loop.run_in_executor(
+                    self.finalize_executor,
+                    partial(
+                        move_to_content_store,
+                        temp_file_path=temp_file_path,
+                        blob_path=self.blob_path(file_unique_id, file_path),
+                        view_path=file_path
+                    )
+                )
+                log.warning(result.get('e_code')) if result.get('e_code') is not None else None
+                file_path = result.get('path') or file_path
+            elif with_move:  # 跨磁盘移动可能很慢,放到线程池中执行,不阻塞事件循环。
+                result: str = (await self.loop.run_in_executor(
+                    self.finalize_executor,
+                    partial(
+                        move_to_save_directory,
+                        temp_file_path=temp_file_path,
+                        save_directory=save_directory
+                    )
+                )).get('e_code')
                 log.warning(result) if result is not None else None
+            if with_move and os.path.isfile(temp_file_path):  # 文件仍在临时目录,移动未完成前不能视为下载完成。
+                log.error(
+                    f'{_t(KeyWord.DOWNLOAD_TASK)}'
+                    f'{_t(KeyWord.FILE)}:"{file_path}"未能移动到保存路径,'
+                    f'{_t(KeyWord.STATUS)}:{_t(DownloadStatus.FAILURE)}。'
+                )
+                return False
             console.log(
                 f'{_t(KeyWord.DOWNLOAD_TASK)}'
                 f'{_t(KeyWord.FILE)}:"{file_path}",'
@@ -1518,7 +1907,7 @@ class TelegramRestrictedMediaDownloader(Bot):
                 f'{_t(KeyWord.TYPE)}:{_t(self.app.get_file_type(message, temp_file_path, DownloadStatus.SUCCESS))},'
                 f'{_t(KeyWord.STATUS)}:{_t(DownloadStatus.SUCCESS)}。',
             )
-            return True
+            return file_path
         console.log(
             f'{_t(KeyWord.DOWNLOAD_TASK)}'
             f'{_t(KeyWord.FILE)}:"{file_path}",'
@@ -1529,6 +1918,104 @@ class TelegramRestrictedMediaDownloader(Bot):
         )
         return False
 
+    def __lookup_download(
+            self,
+            message: pyrogram.types.Message,
+            dtype: str,
+            save_directory: str,
+            sever_file_size: int
+    ) -> Union[str, None]:
+        """查询账本判断文件是否已下载,返回记录的保存路径。记录的文件已被删除、移走或修改(如上传后删除)时视为未下载。
+        账本中没有记录但保存路径下已有大小一致的文件时(启用账本前下载的文件),补录到账本。"""
+        chat_id: Union[int, None] = getattr(getattr(message, 'chat', None), 'id', None)
+        file_unique_id: Union[str, None] = getattr(getattr(message, dtype, None), 'file_unique_id', None)
+        if chat_id is not None and file_unique_id:
+            record: Union[dict, None] = self.ledger.get_download(chat_id, message.id, file_unique_id)
+            if record and is_file_duplicate(save_directory=record.get('path'), sever_file_size=sever_file_size):
+                return record.get('path')
+        if not is_file_duplicate(save_directory=save_directory, sever_file_size=sever_file_size):
+            return None
+        self.__record_download(message=message, file_size=sever_file_size, path=save_directory)
+        return save_directory
+
+    async def __reuse_download(
+            self,
+            message: pyrogram.types.Message,
+            dtype: str,
+            save_directory: str,
+            sever_file_size: int
+    ) -> Union[str, None]:
+        """其他聊天已下载过同一文件(file_unique_id相同)时,在保存路径创建链接代替下载,成功时返回保存路径。"""
+        file_unique_id: Union[str, None] = getattr(getattr(message, dtype, None), 'file_unique_id', None)
+        if not file_unique_id:
+            return None
+        for record in self.ledger.find_downloads(file_unique_id):
+            path: str = record.get('path')
+            if path == save_directory or not is_file_duplicate(save_directory=path, sever_file_size=sever_file_size):
+                continue  # 已被删除、移走或修改的文件。
+            result: dict = await self.loop.run_in_executor(
+                self.finalize_executor,
+                partial(link_file, src=path, dst=save_directory)
+            )
+            if result.get('e_code'):
+                log.warning(result.get('e_code'))
+                return None
+            self.__record_download(message=message, file_size=sever_file_size, path=save_directory)
+            log.info(f'"{save_directory}"与已下载的"{path}"为同一文件,已通过{result.get("method")}复用,无需重新下载。')
+            return save_directory
+        return None
+
+    def __record_download(self, message: pyrogram.types.Message, file_size: int, path: str) -> None:
+        """将下载完成的文件写入账本。"""
+        chat_id: Union[int, None] = getattr(getattr(message, 'chat', None), 'id', None)
+        media = next((getattr(message, _) for _ in DownloadType() if getattr(message, _, None)), None)
+        file_unique_id: Union[str, None] = getattr(media, 'file_unique_id', None)
+        if chat_id is None or not file_unique_id:
+            return None
+        try:
+            self.ledger.set_download(chat_id, message.id, file_unique_id, file_size, path)
+        except Exception as e:
+            log.warning(f'写入下载记录失败,{_t(KeyWord.REASON)}:"{e}"')
+
+    def __settle(self, message: pyrogram.types.Message, failed: bool = False) -> None:
+        """消息已处理完毕(成功、跳过或最终失败),推进其所在聊天的同步水位,失败的消息会在下次同步时重试。"""
+        tracker: Union[Watermark, None] = self.watermarks.get(getattr(getattr(message, 'chat', None), 'id', None))
+        tracker.settle(message.id, failed=failed) if tracker else None
+
+    async def __transfer(self, lane: TaskScheduler, complete: partial, **kwargs) -> None:
+        """传输阶段:下载结束后交给整理阶段,整理队列已满时继续占用名额,使压力回传到准入阶段。"""
+        file_path: Union[str, None] = None
+        try:
+            file_path = await self.resume_download(**kwargs)
+        finally:
+            if file_path and file_path != kwargs.get('file_name'):  # 保存路径被占用,已改为保存到临时目录。
+                complete = partial(complete, temp_file_path=file_path)
+            await self.pipeline['finalize'].put(complete)
+            self.app.current_task_num -= 1
+            lane.release()  # v1.3.4 修复重试下载被阻塞的问题。
+
+    async def __finalize(self, complete: partial) -> None:
+        """整理阶段:校验大小并移动到保存目录,结果交给后处理阶段。"""
+        message: pyrogram.types.Message = complete.keywords.get('message')
+        try:
+            finished: Union[str, bool] = await self.__check_download_finish(
+                message=message,
+                sever_file_size=complete.keywords.get('sever_file_size'),
+                temp_file_path=complete.keywords.get('temp_file_path'),
+                save_directory=self.env_save_directory(message),
+                with_move=True,
+                with_store=not (complete.keywords.get('with_upload') or {}).get('with_delete')
+            )
+        except Exception as e:
+            log.error(f'整理"{complete.keywords.get("file_name")}"时出错,{_t(KeyWord.REASON)}:"{e}"')
+            finished: Union[str, bool] = False
+        await self.pipeline['post'].put(partial(complete, _future=finished))
+
+    @staticmethod
+    async def __post_process(complete: partial) -> None:
+        """后处理阶段:上传、通知以及失败重试。"""
+        complete()
+
     @DownloadTask.on_complete
     def download_complete_callback(
             self,
@@ -1543,9 +2030,11 @@ class TelegramRestrictedMediaDownloader(Bot):
             task_id,
             with_upload,
             diy_download_type,
+            priority,
             _future
     ):
         if task_id is None:
+            self.__settle(message)
             if retry_count == 0:
                 console.log(
                     f'{_t(KeyWord.DOWNLOAD_TASK)}'
@@ -1561,19 +2050,19 @@ class TelegramRestrictedMediaDownloader(Bot):
                 if self.uploader:
                     self.uploader.download_upload(
                         with_upload=with_upload,
-                        file_path=os.path.join(self.env_save_directory(message), file_name)
+                        file_path=_future if isinstance(_future, str) else os.path.join(  # 已存在文件的实际位置。
+                            self.env_save_directory(message), file_name
+                        )
                     )
         else:
-            self.app.current_task_num -= 1
-            self.event.set()  # v1.3.4 修复重试下载被阻塞的问题。
             self.queue.task_done()
-            if self.__check_download_finish(
-                    message=message,
-                    sever_file_size=sever_file_size,
-                    temp_file_path=temp_file_path,
-                    save_directory=self.env_save_directory(message),
-                    with_move=True
-            ):
+            self.__release_path(os.path.join(self.env_save_directory(message), file_name))
+            if _future:  # 整理阶段的结果,为文件校验并移动后所在的路径。
+                file_path: str = _future if isinstance(_future, str) else os.path.join(
+                    self.env_save_directory(message), file_name
+                )
+                self.__record_download(message=message, file_size=sever_file_size, path=file_path)
+                self.__settle(message)
                 MetaData.print_current_task_num(
                     prompt=_t(KeyWord.CURRENT_DOWNLOAD_TASK),
                     num=self.app.current_task_num
@@ -1581,7 +2070,7 @@ class TelegramRestrictedMediaDownloader(Bot):
                 if self.uploader:
                     self.uploader.download_upload(
                         with_upload=with_upload,
-                        file_path=os.path.join(self.env_save_directory(message), file_name)
+                        file_path=file_path
                     )
             else:
                 if retry_count < self.app.max_download_retries:
@@ -1591,7 +2080,8 @@ class TelegramRestrictedMediaDownloader(Bot):
                             message_ids=link if isinstance(link, str) else message,
                             retry={'id': file_id, 'count': retry_count},
                             with_upload=with_upload,
-                            diy_download_type=diy_download_type
+                            diy_download_type=diy_download_type,
+                            priority=priority
                         )
                     )
                     task.add_done_callback(
@@ -1613,6 +2103,7 @@ class TelegramRestrictedMediaDownloader(Bot):
                     )
                     DownloadTask.set_error(link=link, key=file_name, value=_error.replace('。', ''))
                     self.bot_task_link.discard(link)
+                    self.__settle(message, failed=True)
                 link, file_name = None, None
             self.pb.progress.remove_task(task_id=task_id)
         return link, file_name
@@ -1635,19 +2126,130 @@ class TelegramRestrictedMediaDownloader(Bot):
         start_date = date_filter.get('start_date')
         end_date = date_filter.get('end_date')
         download_type: dict = download_chat_filter.get('download_type')
-        links: list = []
-        async for message in self.app.client.get_chat_history(
-                chat_id=chat_id,
-                reverse=True
-        ):
-            if _filter.date_range(message, start_date, end_date) and _filter.dtype(message, download_type):
-                links.append(message.link if message.link else message)
-        for link in links:
-            await self.create_download_task(
-                message_ids=link,
-                single_link=True,
-                diy_download_type=[_ for _ in DownloadType()]
-            )
+        filter_key: str = json.dumps(download_chat_filter, sort_keys=True, default=str)
+        watermark: int = self.ledger.get_watermark(chat_id, filter_key)  # 上次同步已处理到的消息,只获取之后的消息。
+        scanned: dict = {'high': watermark, 'chat_id': None}
+        small_links: list = []
+        large_links: list = []
+
+        def _match(_message) -> bool:
+            # 对完整的Message与扫描时的精简记录均适用。
+            scanned['high'] = max(scanned['high'], _message.id)
+            return _filter.date_range(_message, start_date, end_date) and _filter.dtype(_message, download_type)
+
+        def _collect(_message: pyrogram.types.Message, matched: bool = False) -> None:
+            scanned['chat_id'] = _message.chat.id if _message.chat else scanned['chat_id']
+            if matched or _match(_message):
+                media = next((getattr(_message, _) for _ in DownloadType() if getattr(_message, _, None)), None)
+                is_small: bool = bool(media) and self.get_lane(getattr(media, 'file_size', 0) or 0) is self.small_scheduler
+                (small_links if is_small else large_links).append(
+                    (_message.id, _message, getattr(media, 'file_unique_id', None))  # 直接提交已获取的消息,无需再按链接解析。
+                )
+
+        searched: Union[list, None] = await self.__search_media(chat_id, download_type, start_date, end_date, watermark)
+        if searched is None:  # 服务端无法表达的筛选条件,退回遍历聊天记录,有日期范围时只遍历对应的ID区间。
+            min_id, max_id = await self.app.client.seek_id_range(chat_id, start_date, end_date)
+            if not (end_date and max_id == 0) and not (max_id and max_id <= watermark):  # 区间内没有需要处理的消息。
+                async for message in self.get_history(
+                        chat_id=chat_id,
+                        min_id=max(min_id, watermark),
+                        max_id=max_id,
+                        ordered=False,
+                        predicate=_match  # 只为符合条件的消息构造Message。
+                ):
+                    _collect(message, matched=True)
+        else:
+            for message in searched:
+                _collect(message)
+        failed_ids: list = self.ledger.get_failed(chat_id, filter_key)  # 此前最终失败的消息,重新处理。
+        try:
+            for i in range(0, len(failed_ids), PREFETCH_BATCH):
+                for message in await self.app.client.get_messages(
+                        chat_id=chat_id,
+                        message_ids=failed_ids[i:i + PREFETCH_BATCH]
+                ):
+                    _collect(message) if message and not message.empty else None
+        except Exception as e:
+            log.warning(f'获取"{chat_id}"中此前失败的消息时出错,将在下次同步时重试,{_t(KeyWord.REASON)}:"{e}"')
+            failed_ids = [_ for _ in failed_ids if _ in {__[0] for __ in small_links + large_links}]
+        if scanned.get('chat_id') is not None:  # 一次批量查询账本,排除已下载且文件仍在的消息。
+            downloaded: dict = {
+                key: record for key, record in self.ledger.get_downloads(
+                    scanned.get('chat_id'), [_[0] for _ in small_links + large_links]
+                ).items()
+                if is_file_duplicate(save_directory=record.get('path'), sever_file_size=record.get('file_size'))
+            }
+            total: int = len(small_links) + len(large_links)
+            small_links = [_ for _ in small_links if (_[0], _[2]) not in downloaded]
+            large_links = [_ for _ in large_links if (_[0], _[2]) not in downloaded]
+            skipped: int = total - len(small_links) - len(large_links)
+            log.info(f'"{chat_id}"中有{skipped}个文件已下载过,{_t(DownloadStatus.SKIP)}。') if skipped else None
+        # 分段扫描时消息按到达顺序返回,提交前恢复为ID顺序。
+        small_links.sort(key=lambda _: _[0])
+        large_links.sort(key=lambda _: _[0])
+        tracker = Watermark(
+            ledger=self.ledger,
+            chat_id=chat_id,
+            filter_key=filter_key,
+            message_ids=[_[0] for _ in small_links + large_links],
+            high=scanned.get('high'),
+            retry_ids=failed_ids
+        )
+        # 已删除、不再符合条件或已下载的消息无需再重试。
+        self.ledger.remove_failed(chat_id, filter_key, set(failed_ids) - {_[0] for _ in small_links + large_links})
+        if scanned.get('chat_id') is not None:
+            self.watermarks[scanned.get('chat_id')] = tracker
+
+        async def _feed(_links: list) -> None:
+            for message_id, message, _ in _links:
+                result: dict = await self.create_download_task(
+                    message_ids=message,
+                    single_link=True,
+                    diy_download_type=[_ for _ in DownloadType()]
+                )
+                if result.get('status') == DownloadStatus.FAILURE:
+                    tracker.settle(message_id, failed=True)
+
+        # 大小文件分别按顺序提交,小文件不必等待排在前面的大文件获得名额。
+        await asyncio.gather(_feed(small_links), _feed(large_links))
+
+    async def __search_media(
+            self,
+            chat_id: Union[str, int],
+            download_type: dict,
+            start_date: Optional[float],
+            end_date: Optional[float],
+            min_id: int = 0
+    ) -> Union[list, None]:
+        """用服务端搜索按类型与日期只获取所需的媒体消息,存在服务端无法表达的类型或搜索失败时返回None。"""
+        search_filter: dict = {
+            DownloadType.PHOTO: MessagesFilter.PHOTO,
+            DownloadType.VIDEO: MessagesFilter.VIDEO,
+            DownloadType.DOCUMENT: MessagesFilter.DOCUMENT,
+            DownloadType.AUDIO: MessagesFilter.AUDIO,
+            DownloadType.VOICE: MessagesFilter.VOICE_NOTE,
+            DownloadType.ANIMATION: MessagesFilter.ANIMATION
+        }
+        wanted: list = [dtype for dtype, status in (download_type or {}).items() if status]
+        if not wanted or any(dtype not in search_filter for dtype in wanted):
+            return None
+        min_date = datetime.datetime.fromtimestamp(start_date) if start_date else pyrogram.utils.zero_datetime()
+        max_date = datetime.datetime.fromtimestamp(end_date + 1) if end_date else pyrogram.utils.zero_datetime()
+        messages: dict = {}
+        try:
+            for dtype in wanted:
+                async for message in self.app.client.search_messages(
+                        chat_id=chat_id,
+                        filter=search_filter.get(dtype),
+                        min_date=min_date,
+                        max_date=max_date,
+                        min_id=min_id
+                ):
+                    messages[message.id] = message  # 同一条消息可能被多个筛选条件命中。
+        except Exception as e:
+            log.warning(f'搜索"{chat_id}"中的媒体失败,将遍历全部聊天记录,{_t(KeyWord.REASON)}:"{e}"')
+            return None
+        return list(messages.values())
 
     @DownloadTask.on_create_task
     async def create_download_task(
@@ -1656,7 +2258,8 @@ class TelegramRestrictedMediaDownloader(Bot):
             retry: Union[dict, None] = None,
             single_link: bool = False,
             with_upload: Union[dict, None] = None,
-            diy_download_type: Optional[list] = None
+            diy_download_type: Optional[list] = None,
+            priority: int = TaskPriority.BULK
     ) -> dict:
         retry = retry if retry else {'id': -1, 'count': 0}
         diy_download_type = [_ for _ in DownloadType()] if with_upload else diy_download_type
@@ -1681,7 +2284,7 @@ class TelegramRestrictedMediaDownloader(Bot):
             link_type, chat_id, message, member_num = meta.values()
             DownloadTask.set(link, 'link_type', link_type)
             DownloadTask.set(link, 'member_num', member_num)
-            await self.__add_task(chat_id, link_type, link, message, retry, with_upload, diy_download_type)
+            await self.__add_task(chat_id, link_type, link, message, retry, with_upload, diy_download_type, priority)
             return {
                 'chat_id': chat_id,
                 'member_num': member_num,
@@ -1848,6 +2451,14 @@ class TelegramRestrictedMediaDownloader(Bot):
 
     async def __download_media_from_links(self) -> None:
         await self.app.client.start(use_qr=False)
+        self.loop.create_task(self.concurrency.run()) if self.concurrency else None
+        self.pipeline.start()
+        monitor = self.loop.create_task(
+            self.pipeline.monitor(
+                extra=lambda: f'准入(等待:{self.scheduler.pending()},运行:{self.scheduler.running}/{self.scheduler.limit}),'
+                              f'传输(等待:{self.streams.pending()},运行:{self.streams.running}/{self.streams.limit})'
+            )
+        )
         self.pb.progress.start()  # v1.1.8修复登录输入手机号不显示文本问题。
         if self.app.bot_token is not None:
             result = await self.start_bot(
@@ -1884,9 +2495,13 @@ class TelegramRestrictedMediaDownloader(Bot):
         self.is_running = True
         self.running_log.add(self.is_running)
         links: Union[set, None] = self.__process_links(link=self.app.links)
-        # 将初始任务添加到队列中。
-        [await self.loop.create_task(self.create_download_task(message_ids=link, retry=None)) for link in
-         links] if links else None
+        # 将初始任务添加到队列中,每批链接先按频道批量获取消息,再交给解析阶段。
+        links: list = list(links) if links else []
+        for i in range(0, len(links), PREFETCH_BATCH):  # 解析队列有界,上一批基本被解析后才会预取下一批。
+            await prefetch_messages(client=self.app.client, links=links[i:i + PREFETCH_BATCH])
+            for link in links[i:i + PREFETCH_BATCH]:
+                await self.pipeline['resolve'].put(link)
+        await self.pipeline['resolve'].join()
         # 处理队列中的任务与机器人事件。
         while not self.queue.empty() or self.is_bot_running:
             result = await self.queue.get()
@@ -1897,10 +2512,13 @@ class TelegramRestrictedMediaDownloader(Bot):
                     '临时文件无法移动至下载路径:\n'
                     '1.可能存在使用网络路径、挂载硬盘行为(本软件不支持);\n'
                     '2.可能存在多开软件时,同时操作同一文件或目录导致冲突;\n'
-                    '3.由于软件设计缺陷,没有考虑到不同频道文件名相同的情况(若调整将会导致部分用户更新后重复下载已有文件),当保存路径下文件过多时,可能恰巧存在相同文件名的文件,导致相同文件名无法正常移动,故请定期整理归档下载链接与保存路径下的文件。'
+                    '3.由于软件设计缺陷,没有考虑到不同频道文件名相同的情况(若调整将会导致部分用户更新后重复下载已有文件),当保存路径下文件过多时,可能恰巧存在相同文件名的文件,导致相同文件名无法正常移动,故请定期整理归档下载链接与保存路径下的文件,或开启配置文件中的content_store(按内容保存)。'
                     f'{_t(KeyWord.REASON)}:"{e}"')
         # 等待所有任务完成。
         await self.queue.join()
+        await self.pipeline.join()
+        monitor.cancel()
+        await self.pipeline.stop()
         await self.app.client.stop() if self.app.client.is_connected else None
 
     def run(self) -> None:
@@ -58,6 +58,12 @@ class UploadStatus:
     FAILURE = 'failure'
 
 
+class TaskPriority:
+    INTERACTIVE: int = 0  # 机器人收到的链接。
+    LISTEN: int = 1  # 监听到的新消息。
+    BULK: int = 2  # 配置文件中的链接及download_chat等批量任务。
+
+
 class CalenderKeyboard:
     START_TIME_BUTTON: str = 'start time button'
     END_TIME_BUTTON: str = 'end time button'
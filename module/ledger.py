@@ -0,0 +1,228 @@
+# coding=UTF-8
+# Author:Gentlesprite
+# Software:PyCharm
+# Time:2026/10/19 0:30
+# File:ledger.py
+import time
+import heapq
+import sqlite3
+import threading
+
+from typing import Dict, Union, Iterable
+
+from module import LEDGER_PATH
+
+
+class Ledger:
+    """保存在本地的SQLite账本,记录每个聊天在指定筛选条件下已处理到的消息ID(水位),
+    以及已下载完成的文件与链接,用于去重判断,不依赖文件当前所在的位置。"""
+
+    def __init__(self, path: str = LEDGER_PATH):
+        self.path: str = path
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.__lock:
+            self.__conn.execute('PRAGMA journal_mode=WAL')
+            # WAL下NORMAL只在检查点时fsync,提交不再阻塞事件循环,断电最多丢失最近几次提交,重新同步即可补回。
+            self.__conn.execute('PRAGMA synchronous=NORMAL')
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS watermark ('
+                'chat_id TEXT NOT NULL,'
+                'filter TEXT NOT NULL,'
+                'message_id INTEGER NOT NULL,'
+                'update_time REAL NOT NULL,'
+                'PRIMARY KEY (chat_id, filter))'
+            )
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS failed ('
+                'chat_id TEXT NOT NULL,'
+                'filter TEXT NOT NULL,'
+                'message_id INTEGER NOT NULL,'
+                'update_time REAL NOT NULL,'
+                'PRIMARY KEY (chat_id, filter, message_id))'
+            )
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS download ('
+                'chat_id TEXT NOT NULL,'
+                'message_id INTEGER NOT NULL,'
+                'file_unique_id TEXT NOT NULL,'
+                'file_size INTEGER NOT NULL,'
+                'path TEXT NOT NULL,'
+                'complete_time REAL NOT NULL,'
+                'PRIMARY KEY (chat_id, message_id, file_unique_id))'
+            )
+            self.__conn.execute(
+                'CREATE INDEX IF NOT EXISTS download_file_unique_id ON download (file_unique_id)'
+            )
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS complete_link ('
+                'link TEXT PRIMARY KEY,'
+                'complete_time REAL NOT NULL)'
+            )
+
+    def get_watermark(self, chat_id: Union[int, str], filter_key: str) -> int:
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT message_id FROM watermark WHERE chat_id=? AND filter=?',
+                (str(chat_id), filter_key)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def set_watermark(self, chat_id: Union[int, str], filter_key: str, message_id: int) -> None:
+        """单条语句完成写入,水位只会前进不会后退。"""
+        with self.__lock:
+            self.__conn.execute(
+                'INSERT INTO watermark (chat_id, filter, message_id, update_time) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(chat_id, filter) DO UPDATE SET '
+                'message_id=MAX(message_id, excluded.message_id), update_time=excluded.update_time',
+                (str(chat_id), filter_key, message_id, time.time())
+            )
+
+    def get_failed(self, chat_id: Union[int, str], filter_key: str) -> list:
+        """水位之前最终下载失败的消息,下次同步时需要重新处理。"""
+        with self.__lock:
+            rows: list = self.__conn.execute(
+                'SELECT message_id FROM failed WHERE chat_id=? AND filter=? ORDER BY message_id',
+                (str(chat_id), filter_key)
+            ).fetchall()
+        return [_ for _, in rows]
+
+    def add_failed(self, chat_id: Union[int, str], filter_key: str, message_id: int) -> None:
+        with self.__lock:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO failed (chat_id, filter, message_id, update_time) VALUES (?, ?, ?, ?)',
+                (str(chat_id), filter_key, message_id, time.time())
+            )
+
+    def remove_failed(self, chat_id: Union[int, str], filter_key: str, message_ids: Iterable[int]) -> None:
+        with self.__lock:
+            self.__conn.executemany(
+                'DELETE FROM failed WHERE chat_id=? AND filter=? AND message_id=?',
+                [(str(chat_id), filter_key, _) for _ in message_ids]
+            )
+
+    def get_download(
+            self,
+            chat_id: Union[int, str],
+            message_id: int,
+            file_unique_id: str
+    ) -> Union[dict, None]:
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT file_size, path, complete_time FROM download '
+                'WHERE chat_id=? AND message_id=? AND file_unique_id=?',
+                (str(chat_id), message_id, file_unique_id)
+            ).fetchone()
+        return {'file_size': row[0], 'path': row[1], 'complete_time': row[2]} if row else None
+
+    def get_downloads(self, chat_id: Union[int, str], message_ids: Iterable[int]) -> Dict[tuple, dict]:
+        """批量查询一个聊天中已下载的消息,返回{(消息ID,file_unique_id):记录}。"""
+        message_ids: list = list(message_ids)
+        result: Dict[tuple, dict] = {}
+        with self.__lock:
+            for index in range(0, len(message_ids), 500):  # 不超过SQLite单条语句的参数数量限制。
+                batch: list = message_ids[index:index + 500]
+                for message_id, file_unique_id, file_size, path, complete_time in self.__conn.execute(
+                        f'SELECT message_id, file_unique_id, file_size, path, complete_time FROM download '
+                        f'WHERE chat_id=? AND message_id IN ({",".join("?" * len(batch))})',
+                        (str(chat_id), *batch)
+                ):
+                    result[(message_id, file_unique_id)] = {
+                        'file_size': file_size,
+                        'path': path,
+                        'complete_time': complete_time
+                    }
+        return result
+
+    def find_downloads(self, file_unique_id: str) -> list:
+        """按file_unique_id查找所有聊天中已下载的同一文件,最近完成的在前。"""
+        with self.__lock:
+            rows: list = self.__conn.execute(
+                'SELECT file_size, path, complete_time FROM download WHERE file_unique_id=? '
+                'ORDER BY complete_time DESC',
+                (file_unique_id,)
+            ).fetchall()
+        return [{'file_size': file_size, 'path': path, 'complete_time': complete_time} for file_size, path, complete_time in rows]
+
+    def set_download(
+            self,
+            chat_id: Union[int, str],
+            message_id: int,
+            file_unique_id: str,
+            file_size: int,
+            path: str
+    ) -> None:
+        with self.__lock:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO download '
+                '(chat_id, message_id, file_unique_id, file_size, path, complete_time) VALUES (?, ?, ?, ?, ?, ?)',
+                (str(chat_id), message_id, file_unique_id, file_size, path, time.time())
+            )
+
+    def get_complete_links(self, links: Iterable[str]) -> set:
+        """返回links中已全部下载完成的链接。"""
+        links: list = [_ for _ in links if isinstance(_, str)]
+        result: set = set()
+        with self.__lock:
+            for index in range(0, len(links), 500):
+                batch: list = links[index:index + 500]
+                result.update(_ for _, in self.__conn.execute(
+                    f'SELECT link FROM complete_link WHERE link IN ({",".join("?" * len(batch))})',
+                    batch
+                ))
+        return result
+
+    def set_complete_link(self, link: str) -> None:
+        with self.__lock:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO complete_link (link, complete_time) VALUES (?, ?)',
+                (link, time.time())
+            )
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.close()
+
+
+class Watermark:
+    """一次同步的水位跟踪,只有比某条消息更早的消息全部处理完后,水位才会推进到该消息之前。
+    最终失败的消息先记录到账本的failed表再推进水位,下次同步时重新处理。"""
+
+    def __init__(
+            self,
+            ledger: Ledger,
+            chat_id: Union[int, str],
+            filter_key: str,
+            message_ids: Iterable[int],
+            high: int,
+            retry_ids: Iterable[int] = ()
+    ):
+        self.ledger: Ledger = ledger
+        self.chat_id: Union[int, str] = chat_id
+        self.filter_key: str = filter_key
+        self.value: int = ledger.get_watermark(chat_id, filter_key)
+        self.__pending: set = set(message_ids)
+        self.__retry: set = set(retry_ids) & self.__pending  # 来自failed表的消息。
+        self.__heap: list = list(self.__pending)
+        heapq.heapify(self.__heap)
+        self.__high: int = max([high, *self.__pending]) if self.__pending else high
+        self.__advance()
+
+    def settle(self, message_id: int, failed: bool = False) -> None:
+        """标记一条消息已处理(成功、跳过或最终失败)。"""
+        if message_id not in self.__pending:
+            return None
+        if failed:
+            self.ledger.add_failed(self.chat_id, self.filter_key, message_id)
+        elif message_id in self.__retry:
+            self.ledger.remove_failed(self.chat_id, self.filter_key, [message_id])
+        self.__pending.discard(message_id)
+        self.__advance()
+
+    def __advance(self) -> None:
+        while self.__heap and self.__heap[0] not in self.__pending:
+            heapq.heappop(self.__heap)
+        value: int = self.__heap[0] - 1 if self.__heap else self.__high
+        if value > self.value:
+            self.value = value
+            self.ledger.set_watermark(self.chat_id, self.filter_key, value)
@@ -0,0 +1,145 @@
+# coding=UTF-8
+# Author:Gentlesprite
+# Software:PyCharm
+# Time:2026/10/18 21:10
+# File:manifest.py
+import os
+import json
+import math
+import base64
+import threading
+
+from typing import List, Tuple, Union
+
+from module import log
+from module.language import _t
+from module.enums import KeyWord
+
+
+class PartManifest:
+    """临时文件旁的分块清单,以位图记录已写入完成的块,支持乱序写入与崩溃后只补齐缺失的块。"""
+    SUFFIX: str = '.manifest'
+
+    def __init__(
+            self,
+            temp_path: str,
+            file_size: int,
+            file_unique_id: Union[str, None],
+            chunk_size: int = 1024 * 1024
+    ):
+        self.path: str = temp_path + PartManifest.SUFFIX
+        self.file_size: int = file_size
+        self.file_unique_id: Union[str, None] = file_unique_id
+        self.chunk_size: int = chunk_size
+        self.part_num: int = math.ceil(file_size / chunk_size)
+        self.bitmap: bytearray = bytearray(math.ceil(self.part_num / 8))
+        self.persistent: bool = self.part_num > 1  # 只有一块的文件不需要落盘清单,中断后重新下载即可。
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def load(
+            cls,
+            temp_path: str,
+            file_size: int,
+            file_unique_id: Union[str, None],
+            chunk_size: int = 1024 * 1024
+    ) -> 'PartManifest':
+        """读取清单,清单与当前文件不匹配或已损坏时返回空清单。"""
+        manifest = cls(temp_path, file_size, file_unique_id, chunk_size)
+        if not os.path.isfile(manifest.path):
+            if os.path.isfile(temp_path):  # 没有清单的旧缓存文件,只信任按块对齐的前缀部分。
+                manifest.mark_prefix(os.path.getsize(temp_path))
+            return manifest
+        try:
+            with open(file=manifest.path, mode='r', encoding='UTF-8') as f:
+                meta: dict = json.load(f)
+            bitmap: bytes = base64.b64decode(meta.get('bitmap', ''))
+            if (
+                    meta.get('file_size') == file_size and
+                    meta.get('chunk_size') == chunk_size and
+                    meta.get('file_unique_id') == file_unique_id and
+                    len(bitmap) == len(manifest.bitmap) and
+                    os.path.isfile(temp_path)
+            ):
+                manifest.bitmap = bytearray(bitmap)
+            else:
+                log.warning(f'分块清单"{manifest.path}"与当前文件不匹配,将重新下载。')
+        except Exception as e:
+            log.warning(f'读取分块清单"{manifest.path}"失败,将重新下载,{_t(KeyWord.REASON)}:"{e}"')
+        return manifest
+
+    @staticmethod
+    def peek(temp_path: str) -> Union[int, None]:
+        """不做校验地读取清单中已完成的字节数,没有清单时返回None。"""
+        try:
+            with open(file=temp_path + PartManifest.SUFFIX, mode='r', encoding='UTF-8') as f:
+                meta: dict = json.load(f)
+            manifest = PartManifest(temp_path, meta.get('file_size'), meta.get('file_unique_id'), meta.get('chunk_size'))
+            manifest.bitmap = bytearray(base64.b64decode(meta.get('bitmap', '')))
+            return manifest.completed_size()
+        except Exception:
+            return None
+
+    def is_done(self, index: int) -> bool:
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def mark(self, offset: int, length: int) -> None:
+        """标记一个已写入的块,只有写满整块(或文件最后一块)时才视为完成。"""
+        if offset % self.chunk_size or not (length == self.chunk_size or offset + length == self.file_size):
+            return None
+        index: int = offset // self.chunk_size
+        with self.__lock:
+            self.bitmap[index >> 3] |= 1 << (index & 7)
+
+    def mark_prefix(self, size: int) -> None:
+        for index in range(min(size, self.file_size) // self.chunk_size):
+            self.mark(index * self.chunk_size, self.chunk_size)
+        if size >= self.file_size and self.part_num:
+            last: int = (self.part_num - 1) * self.chunk_size
+            self.mark(last, self.file_size - last)
+
+    def missing(self) -> List[Tuple[int, int]]:
+        """以(起始块,块数)的形式返回所有缺失的连续块区间。"""
+        runs: list = []
+        for index in range(self.part_num):
+            if self.is_done(index):
+                continue
+            if runs and runs[-1][0] + runs[-1][1] == index:
+                runs[-1][1] += 1
+            else:
+                runs.append([index, 1])
+        return [(start, count) for start, count in runs]
+
+    def completed_size(self) -> int:
+        size: int = 0
+        for index in range(self.part_num):
+            if self.is_done(index):
+                size += min(self.chunk_size, self.file_size - index * self.chunk_size)
+        return size
+
+    def is_complete(self) -> bool:
+        return all(self.is_done(index) for index in range(self.part_num))
+
+    def save(self) -> None:
+        """先写入临时文件再替换,保证清单本身不会因崩溃而损坏。
+        调用方需确保已标记的块的数据已经落盘(fsync),否则崩溃后清单可能记录了实际未写入的块。"""
+        if not self.persistent:
+            return None
+        with self.__lock:
+            bitmap: str = base64.b64encode(bytes(self.bitmap)).decode()
+        tmp_path: str = self.path + '.tmp'
+        with open(file=tmp_path, mode='w', encoding='UTF-8') as f:
+            json.dump(
+                {
+                    'file_unique_id': self.file_unique_id,
+                    'file_size': self.file_size,
+                    'chunk_size': self.chunk_size,
+                    'bitmap': bitmap
+                }, f
+            )
+        os.replace(tmp_path, self.path)
+
+    def delete(self) -> None:
+        for path in (self.path, self.path + '.tmp'):
+            if os.path.isfile(path):
+                os.remove(path)
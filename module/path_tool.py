@@ -5,6 +5,8 @@
 # File:path_tool.py
 import os
 import re
+import sys
+import errno
 import struct
 import shutil
 import datetime
@@ -113,22 +115,87 @@ def safe_delete(file_p_d: str) -> bool:
         return False
 
 
-def safe_replace(origin_file: str, overwrite_file: str) -> dict:
+def __kernel_copy(src: str, dst: str, chunk_size: int = 1024 * 1024 * 1024) -> None:
+    """复制文件内容,优先使用copy_file_range与sendfile在内核中完成,不支持时退化为普通读写。"""
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        size: int = os.fstat(s.fileno()).st_size
+        offset: int = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while offset < size:
+                    copied: int = os.copy_file_range(s.fileno(), d.fileno(), min(chunk_size, size - offset), offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError:
+                pass  # 内核或文件系统不支持跨文件系统的copy_file_range。
+        if offset < size and sys.platform.startswith('linux'):
+            try:
+                os.lseek(d.fileno(), offset, os.SEEK_SET)
+                while offset < size:
+                    sent: int = os.sendfile(d.fileno(), s.fileno(), offset, min(chunk_size, size - offset))
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                pass
+        if offset < size:
+            s.seek(offset)
+            d.seek(offset)
+            shutil.copyfileobj(s, d, 1024 * 1024)
+
+
+def __place(src: str, dst: str, overwrite: bool) -> None:
+    """将src重命名为dst,overwrite为False时通过硬链接原子地放置,dst已存在则抛出FileExistsError。"""
+    if overwrite:
+        os.replace(src, dst)
+        return None
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            raise
+        if os.path.exists(dst):  # 文件系统不支持硬链接时,退化为先检查再重命名。
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        os.replace(src, dst)
+        return None
+    os.remove(src)
+
+
+def move_file(src: str, dst: str, overwrite: bool = True) -> None:
+    """移动文件,overwrite为False时不会覆盖已存在的dst。无法直接重命名(跨文件系统)时先在内核中复制到dst旁的临时文件,
+    复制完成后再放置到dst并删除源文件,中途失败不会留下不完整的dst。"""
+    try:
+        __place(src, dst, overwrite)
+        return None
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_path: str = f'{dst}.temp'
+    try:
+        __kernel_copy(src, temp_path)
+        shutil.copystat(src, temp_path)
+        __place(temp_path, dst, overwrite)
+    except BaseException:
+        safe_delete(temp_path)
+        raise
+    os.remove(src)
+
+
+def safe_replace(origin_file: str, overwrite_file: str, overwrite: bool = True) -> dict:
     e_code = None
     if not os.path.isfile(origin_file):
         e_code = f'"{origin_file}"不存在或不是一个文件。'
         return {'e_code': e_code}
 
     try:
-        os.replace(origin_file, overwrite_file)
-    except OSError as e:
-        if 'Invalid cross-device link' in str(e):
-            try:
-                shutil.move(origin_file, overwrite_file)
-            except Exception as e2:
-                e_code = f'移动文件失败,原因:"{e2}"'
-        else:
-            e_code = f'覆盖文件失败,原因:"{e}"'
+        move_file(origin_file, overwrite_file, overwrite=overwrite)
+    except FileExistsError:
+        e_code = f'"{overwrite_file}"已存在,未覆盖。'
+    except Exception as e:
+        e_code = f'覆盖文件失败,原因:"{e}"'
 
     return {'e_code': e_code}
 
@@ -141,12 +208,12 @@ def move_to_save_directory(temp_file_path: str, save_directory: str) -> dict:
             file_name: str = split_path(temp_file_path).get('file_name')
             if os.path.exists(os.path.join(save_directory, file_name)):
                 return {'e_code': f'"{file_name}"已存在于保存路径无法移动,请手动解决冲突。'}
-            shutil.move(temp_file_path, save_directory)
+            move_file(temp_file_path, os.path.join(save_directory, file_name), overwrite=False)  # 检查后仍可能被其他任务占用。
             return {'e_code': None}
         else:
             save_directory: str = os.path.join(os.getcwd(), 'downloads')
             os.makedirs(save_directory, exist_ok=True)
-            shutil.move(temp_file_path, save_directory)
+            move_file(temp_file_path, os.path.join(save_directory, split_path(temp_file_path).get('file_name')))
             return {'e_code': f'"{save_directory}"不是一个目录,已将文件下载到默认目录。'}
     except FileExistsError as e:
         return {'e_code': f'"{save_directory}"已存在,不能重复保存,原因:"{e}'}
@@ -156,6 +223,89 @@ def move_to_save_directory(temp_file_path: str, save_directory: str) -> dict:
         return {'e_code': f'意外的错误,原因:"{e}"'}
 
 
+def __reflink(src: str, dst: str) -> bool:
+    """通过FICLONE创建写时复制的副本,仅Linux上的Btrfs、XFS等文件系统支持。"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), 0x40049409, s.fileno())  # FICLONE。
+            return True
+        except OSError:
+            pass
+    safe_delete(dst)
+    return False
+
+
+def link_file(src: str, dst: str) -> dict:
+    """在dst创建与src内容相同的文件,依次尝试硬链接、reflink与复制,不会覆盖已存在的dst。"""
+    try:
+        os.makedirs(split_path(dst).get('directory') or os.getcwd(), exist_ok=True)
+        if os.path.exists(dst):
+            return {'e_code': f'"{dst}"已存在。', 'method': None}
+        try:
+            os.link(src, dst)
+            return {'e_code': None, 'method': 'hardlink'}
+        except OSError:
+            pass  # 跨文件系统或文件系统不支持硬链接。
+        temp_path: str = f'{dst}.temp'
+        method: str = 'reflink' if __reflink(src, temp_path) else 'copy'
+        if method == 'copy':
+            shutil.copy2(src, temp_path)
+        os.replace(temp_path, dst)
+        return {'e_code': None, 'method': method}
+    except Exception as e:
+        safe_delete(f'{dst}.temp')
+        return {'e_code': f'复用文件失败,原因:"{e}"', 'method': None}
+
+
+def move_to_content_store(temp_file_path: str, blob_path: str, view_path: str) -> dict:
+    """将文件按内容保存为blob_path,再在view_path创建指向它的链接(视图)。
+    blob已存在时直接复用;view_path已被其他文件占用时在文件名后附加blob名作为视图,因此不会因重名失败。"""
+    try:
+        os.makedirs(split_path(blob_path).get('directory'), exist_ok=True)
+        if os.path.isfile(blob_path) and compare_file_size(os.path.getsize(blob_path), os.path.getsize(temp_file_path)):
+            safe_delete(temp_file_path)  # 相同内容已保存过(重试或其他频道)。
+        else:
+            e_code: Union[str, None] = safe_replace(origin_file=temp_file_path, overwrite_file=blob_path).get('e_code')
+            if e_code:
+                return {'e_code': e_code, 'path': None}
+        if os.path.exists(view_path) and os.path.samefile(view_path, blob_path):
+            return {'e_code': None, 'path': view_path}
+        if os.path.exists(view_path):
+            stem, ext = os.path.splitext(view_path)
+            view_path = f'{stem} ({os.path.splitext(split_path(blob_path).get("file_name"))[0]}){ext}'
+            if os.path.exists(view_path):  # 名称中含blob名的视图只可能指向同一内容。
+                return {'e_code': None, 'path': view_path}
+        e_code: Union[str, None] = link_file(src=blob_path, dst=view_path).get('e_code')
+        return {'e_code': e_code, 'path': None if e_code else view_path}
+    except Exception as e:
+        return {'e_code': f'意外的错误,原因:"{e}"', 'path': None}
+
+
+def preallocate_file(file_path: str, size: int) -> bool:
+    """将文件预分配到指定大小,支持时使用fallocate,否则以稀疏文件的方式扩展。"""
+    try:
+        fd: int = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            if os.fstat(fd).st_size >= size:
+                return True
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                    return True
+                except OSError:
+                    pass  # 文件系统不支持时退化为截断。
+            os.ftruncate(fd, size)
+            return True
+        finally:
+            os.close(fd)
+    except OSError:
+        return False
+
+
 def get_extension(file_id: str, mime_type: str, dot: bool = True) -> str:
     """获取文件的扩展名。
     更多扩展名见: https://www.iana.org/assignments/media-types/media-types.xhtml
@@ -0,0 +1,116 @@
+# coding=UTF-8
+# Author:Gentlesprite
+# Software:PyCharm
+# Time:2026/10/18 23:20
+# File:pipeline.py
+import time
+import asyncio
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Union
+
+from module import log
+from module.language import _t
+from module.enums import KeyWord
+
+
+class Stage:
+    """流水线中的一个阶段,由有界队列与固定数量的工作协程组成,并记录处理数量与耗时。"""
+
+    def __init__(
+            self,
+            name: str,
+            handler: Callable[[Any], Awaitable],
+            workers: int = 1,
+            maxsize: int = 0
+    ):
+        self.name: str = name
+        self.handler: Callable[[Any], Awaitable] = handler
+        self.workers: int = max(workers, 1)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize or self.workers * 4)
+        self.busy: int = 0
+        self.done: int = 0
+        self.failed: int = 0
+        self.elapsed: float = 0
+        self.__tasks: list = []
+
+    def start(self) -> None:
+        if not self.__tasks:
+            self.__tasks = [asyncio.create_task(self.__work()) for _ in range(self.workers)]
+
+    async def put(self, item: Any) -> None:
+        """投递到本阶段,队列已满时等待,使压力回传给上一阶段。"""
+        await self.queue.put(item)
+
+    async def join(self) -> None:
+        await self.queue.join()
+
+    async def stop(self) -> None:
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks = []
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            'backlog': self.queue.qsize(),
+            'busy': self.busy,
+            'done': self.done,
+            'failed': self.failed,
+            'average': self.elapsed / max(self.done + self.failed, 1)
+        }
+
+    async def __work(self) -> None:
+        while True:
+            item = await self.queue.get()
+            self.busy += 1
+            start: float = time.monotonic()
+            try:
+                await self.handler(item)
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                log.error(f'流水线阶段"{self.name}"处理出错,{_t(KeyWord.REASON)}:"{e}"')
+            finally:
+                self.elapsed += time.monotonic() - start
+                self.busy -= 1
+                self.queue.task_done()
+
+
+class Pipeline:
+    """按顺序串联的多个阶段,可定期在日志中输出各阶段的积压情况。"""
+
+    def __init__(self, *stages: Stage):
+        self.stages: OrderedDict = OrderedDict((stage.name, stage) for stage in stages)
+
+    def __getitem__(self, name: str) -> Stage:
+        return self.stages[name]
+
+    def start(self) -> None:
+        for stage in self.stages.values():
+            stage.start()
+
+    async def join(self) -> None:
+        for stage in self.stages.values():
+            await stage.join()
+
+    async def stop(self) -> None:
+        for stage in self.stages.values():
+            await stage.stop()
+
+    def report(self) -> str:
+        return ','.join(
+            f'{name}(排队:{s["backlog"]},处理中:{s["busy"]},完成:{s["done"]},失败:{s["failed"]},'
+            f'平均耗时:{s["average"]:.2f}s)'
+            for name, s in ((name, stage.stats()) for name, stage in self.stages.items())
+        )
+
+    async def monitor(self, interval: float = 30, extra: Union[Callable[[], str], None] = None) -> None:
+        """定期记录各阶段状态,状态没有变化时不重复输出。"""
+        last: str = ''
+        while True:
+            await asyncio.sleep(interval)
+            report: str = ','.join(_ for _ in (extra() if extra else '', self.report()) if _)
+            if report != last:
+                log.info(f'流水线状态:{report}。')
+                last = report
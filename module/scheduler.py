@@ -0,0 +1,155 @@
+# coding=UTF-8
+# Author:Gentlesprite
+# Software:PyCharm
+# Time:2026/10/18 22:30
+# File:scheduler.py
+import time
+import asyncio
+
+from collections import deque, OrderedDict
+from typing import Dict, Hashable
+
+from module import log
+from module.stdio import MetaData
+from module.enums import TaskPriority
+
+
+class TaskScheduler:
+    """任务准入调度器,高优先级的任务先放行,同一优先级内按聊天公平轮转,避免单个大批量任务独占名额。"""
+
+    def __init__(self, limit: int):
+        self.__limit: int = max(limit, 1)
+        self.running: int = 0
+        self.__waiters: Dict[int, OrderedDict] = {}  # 优先级 -> {聊天: 等待队列}。
+        self.__vtime: Dict[int, Dict[Hashable, int]] = {}  # 优先级 -> {聊天: 已获得的名额数}。
+        self.__clock: Dict[int, int] = {}  # 优先级 -> 最近一次放行时的名额数。
+
+    @property
+    def limit(self) -> int:
+        return self.__limit
+
+    @limit.setter
+    def limit(self, value: int) -> None:
+        self.__limit = max(value, 1)
+        self.__dispatch()
+
+    def pending(self) -> int:
+        return sum(len(_) for queues in self.__waiters.values() for _ in queues.values())
+
+    async def acquire(self, priority: int = TaskPriority.BULK, key: Hashable = None) -> None:
+        """等待一个空闲名额,被取消时若已分得名额则自动归还。"""
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        queues: OrderedDict = self.__waiters.setdefault(priority, OrderedDict())
+        vtime: dict = self.__vtime.setdefault(priority, {})
+        if key not in queues:  # 重新排队的聊天从当前进度起算,不能用空闲期间积攒的份额插队。
+            queues[key] = deque()
+            vtime[key] = max(vtime.get(key, 0), self.__clock.get(priority, 0))
+        queues[key].append(future)
+        self.__dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self.__discard(priority, key, future)
+            raise
+
+    def release(self) -> None:
+        self.running = max(self.running - 1, 0)
+        self.__dispatch()
+
+    def __dispatch(self) -> None:
+        while self.running < self.__limit:
+            future = self.__next()
+            if future is None:
+                return None
+            if future.done():  # 已取消的等待者。
+                continue
+            future.set_result(None)
+            self.running += 1
+
+    def __next(self) -> asyncio.Future:
+        for priority in sorted(self.__waiters):
+            queues: OrderedDict = self.__waiters[priority]
+            if not queues:
+                continue
+            vtime: dict = self.__vtime[priority]
+            key = min(queues, key=lambda _: vtime[_])
+            self.__clock[priority] = vtime[key]
+            vtime[key] += 1
+            future: asyncio.Future = queues[key].popleft()
+            if not queues[key]:
+                del queues[key]
+                for _ in [_ for _ in vtime if _ not in queues and vtime[_] <= self.__clock[priority]]:
+                    del vtime[_]  # 已经不会影响排序的空闲聊天。
+            return future
+        return None
+
+    def __discard(self, priority: int, key: Hashable, future: asyncio.Future) -> None:
+        queues: OrderedDict = self.__waiters.get(priority, OrderedDict())
+        if key in queues and future in queues[key]:
+            queues[key].remove(future)
+            if not queues[key]:
+                del queues[key]
+
+
+class AdaptiveConcurrency:
+    """以AIMD方式调整调度器的名额:吞吐仍在提升时逐个增加,遇到FloodWait或传输卡住时减半,上限为ceiling。
+    下载时作用于所有文件共享的分段传输名额,因此与统计的吞吐、受到的惩罚针对的是同一组请求。"""
+
+    def __init__(self, scheduler: TaskScheduler, ceiling: int, interval: float = 10):
+        self.scheduler: TaskScheduler = scheduler
+        self.ceiling: int = max(ceiling, 1)
+        self.interval: float = interval
+        self.scheduler.limit = max(-(-self.ceiling // 2), 1)  # 从上限的一半起步。
+        self.__bytes: int = 0
+        self.__last_rate: float = 0
+        self.__increased: bool = False
+        self.__last_decrease: float = 0
+
+    def feed(self, size: int) -> None:
+        """记录新下载的字节数。"""
+        self.__bytes += size
+
+    def penalize(self, reason: str) -> None:
+        """乘性减少名额,同一统计周期内只减少一次,避免一次拥塞被重复惩罚。"""
+        now: float = time.monotonic()
+        if now - self.__last_decrease < self.interval:
+            return None
+        self.__last_decrease = now
+        self.__increased = False
+        self.__last_rate = 0
+        limit: int = max(self.scheduler.limit // 2, 1)
+        if limit != self.scheduler.limit:
+            self.scheduler.limit = limit
+            log.info(f'{reason},下载并发已降低至{limit}/{self.ceiling}。')
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.adjust()
+
+    def adjust(self) -> None:
+        """每个统计周期调用一次,根据本周期的吞吐决定是否增加名额。"""
+        rate: float = self.__bytes / self.interval
+        self.__bytes = 0
+        if time.monotonic() - self.__last_decrease < self.interval:
+            return None
+        limit: int = self.scheduler.limit
+        saturated: bool = self.scheduler.running >= limit and self.scheduler.pending() > 0
+        if self.__increased and rate < self.__last_rate * 0.9:  # 上次增加后吞吐反而下降,退回原来的名额。
+            limit = max(limit - 1, 1)
+            self.__increased = False
+        elif saturated and limit < self.ceiling and rate >= self.__last_rate * 1.05:
+            limit += 1
+            self.__increased = True
+        else:
+            self.__increased = False
+        self.__last_rate = rate
+        if limit != self.scheduler.limit:
+            self.scheduler.limit = limit
+            log.info(
+                f'下载并发已调整为{limit}/{self.ceiling},'
+                f'当前速度:{MetaData.suitable_units_display(int(rate))}/s。'
+            )
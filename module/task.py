@@ -23,7 +23,6 @@ from module.enums import (
 
 class DownloadTask:
     LINK_INFO: dict = {}
-    COMPLETE_LINK: set = set()
 
     def __init__(
             self,
@@ -96,7 +95,7 @@ class DownloadTask:
                     f'{_t(KeyWord.STATUS)}:{_t(DownloadStatus.SUCCESS)}。'
                 )
                 DownloadTask.LINK_INFO.get(link)['error_msg'] = {}
-                DownloadTask.COMPLETE_LINK.add(link)
+                self.ledger.set_complete_link(link) if isinstance(link, str) else None  # 写入账本,重启后仍能识别。
                 asyncio.create_task(self.done_notice(f'"{link}"已下载完成。'))
             return res
 
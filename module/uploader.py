@@ -30,9 +30,11 @@ from module.path_tool import (
     split_path,
     safe_delete
 )
+from module.scheduler import TaskScheduler
 from module.enums import (
     KeyWord,
-    UploadStatus
+    UploadStatus,
+    TaskPriority
 )
 from module.util import (
     parse_link,
@@ -55,10 +57,10 @@ class TelegramUploader:
     ):
         self.client: pyrogram.Client = client
         self.loop = loop
-        self.event = asyncio.Event()
         self.pb = progress
         self.current_task_num = 0
         self.max_upload_task = max_upload_task
+        self.scheduler = TaskScheduler(limit=max_upload_task)
         self.max_retry_count = max_retry_count
         self.is_premium: bool = is_premium
         self.notify: Callable = notify
@@ -151,7 +153,8 @@ class TelegramUploader:
             self,
             link: str,
             file_path: str,
-            with_delete: bool = False
+            with_delete: bool = False,
+            priority: int = TaskPriority.BULK
     ):
         target_meta: Union[dict, None] = await parse_link(
             client=self.client,
@@ -195,7 +198,8 @@ class TelegramUploader:
                     chat_id=chat_id,
                     file_path=file_path,
                     size=file_size,
-                    with_delete=with_delete
+                    with_delete=with_delete,
+                    priority=priority
                 )
                 return {
                     'chat_id': chat_id,
@@ -225,40 +229,43 @@ class TelegramUploader:
             chat_id: Union[str, int],
             file_path: str,
             size: int,
-            with_delete: bool = False
+            with_delete: bool = False,
+            priority: int = TaskPriority.BULK
     ):
-        while self.current_task_num >= self.max_upload_task:  # v1.0.7 增加下载任务数限制。
-            await self.event.wait()
-            self.event.clear()
-        format_file_size: str = MetaData.suitable_units_display(size)
-        task_id = self.pb.progress.add_task(
-            description='📤',
-            filename=truncate_display_filename(split_path(file_path).get('file_name')),
-            info=f'0.00B/{format_file_size}',
-            total=size
-        )
-        _task = self.loop.create_task(
-            self.send_media(
-                chat_id=chat_id,
-                path=file_path,
-                progress=self.pb.bar,
-                progress_args=(
-                    self.pb.progress,
-                    task_id
+        await self.scheduler.acquire(priority=priority, key=chat_id)  # 按优先级及聊天公平地等待上传名额。
+        _task = None
+        try:
+            format_file_size: str = MetaData.suitable_units_display(size)
+            task_id = self.pb.progress.add_task(
+                description='📤',
+                filename=truncate_display_filename(split_path(file_path).get('file_name')),
+                info=f'0.00B/{format_file_size}',
+                total=size
+            )
+            _task = self.loop.create_task(
+                self.send_media(
+                    chat_id=chat_id,
+                    path=file_path,
+                    progress=self.pb.bar,
+                    progress_args=(
+                        self.pb.progress,
+                        task_id
+                    )
                 )
             )
-        )
-        _task.add_done_callback(
-            partial(
-                self.upload_complete_callback,
-                chat_id,
-                size,
-                file_path,
-                task_id,
-                with_delete
+            _task.add_done_callback(
+                partial(
+                    self.upload_complete_callback,
+                    chat_id,
+                    size,
+                    file_path,
+                    task_id,
+                    with_delete
+                )
             )
-        )
-
+        finally:
+            if _task is None:
+                self.scheduler.release()
         if _task:
             self.current_task_num += 1
             MetaData.print_current_task_num(
@@ -280,7 +287,7 @@ class TelegramUploader:
         self.current_task_num -= 1
         self.pb.progress.remove_task(task_id=task_id)
         asyncio.create_task(self.notify(f'"{file_path}"已上传完成。')) if isinstance(self.notify, Callable) else None
-        self.event.set()
+        self.scheduler.release()
         if with_delete:
             safe_delete(file_path)
             more = '(本地文件已删除)'
@@ -18,12 +18,18 @@ from pyrogram.types.messages_and_media import ReplyParameters
 from urllib.parse import parse_qs, urlparse
 from rich.text import Text
 
+from module.cache import TTLCache
 from module.enums import (
     Link,
     LinkType,
     DownloadType
 )
 
+MESSAGE_CACHE = TTLCache(maxsize=1024, ttl=600)  # 已解析的链接,键为(频道,消息ID,链接参数)。
+PREFETCH_CACHE = TTLCache(maxsize=4096, ttl=float('inf'))  # 批量预取的消息,键为(频道,消息ID),不按时间过期,取用后即移除。
+PREFETCH_BATCH: int = 200  # get_messages单次请求允许的最大消息数。
+ALBUM_CACHE = TTLCache(maxsize=1024, ttl=600)  # 媒体组中的所有消息,键为(频道,media_group_id)。
+
 
 def safe_index(lst: list, index: int, default=None):
     try:
@@ -125,11 +131,8 @@ def extract_info_from_link(link: str) -> Link:
     return result
 
 
-async def get_message_by_link(
-        client: pyrogram.Client,
-        link: str,
-        single_link: bool = False  # 为True时,将每个链接都视作是单文件。
-) -> Union[dict, None]:
+def __parse_message_link(link: str, single_link: bool = False) -> tuple:
+    """解析消息链接,返回(频道,消息ID,是否单文件,链接类型,缓存键)。"""
     origin_link: str = link
     record_type: set = set()
     link: str = link[:-1] if link.endswith('/') else link
@@ -161,6 +164,55 @@ async def get_message_by_link(
     except ValueError:
         chat_id = match.group(1)
     message_id: int = int(match.group(2))
+    cache_key: tuple = (
+        chat_id,
+        message_id,
+        single_link,
+        frozenset(record_type),
+        origin_link.split('=')[-1] if '=' in origin_link else None
+    )
+    return chat_id, message_id, single_link, record_type, cache_key
+
+
+async def prefetch_messages(
+        client: pyrogram.Client,
+        links: List[str]
+) -> None:
+    """按频道分组,用一次get_messages批量获取多条链接的消息,供随后的get_message_by_link直接取用。"""
+    chat_ids: dict = {}
+    for link in links:
+        try:
+            chat_id, message_id, _, __, cache_key = __parse_message_link(link)
+        except ValueError:
+            continue
+        if cache_key in MESSAGE_CACHE or (chat_id, message_id) in PREFETCH_CACHE:
+            continue
+        chat_ids.setdefault(chat_id, set()).add(message_id)
+    for chat_id, _message_ids in chat_ids.items():
+        message_ids: list = sorted(_message_ids)
+        for i in range(0, len(message_ids), PREFETCH_BATCH):
+            try:
+                messages: list = await client.get_messages(
+                    chat_id=chat_id,
+                    message_ids=message_ids[i:i + PREFETCH_BATCH]
+                )
+            except Exception:  # 预取失败时退回逐条解析,由get_message_by_link报告具体错误。
+                break
+            for message in messages:
+                if message and not getattr(message, 'empty', False):
+                    PREFETCH_CACHE.set((chat_id, message.id), message)
+
+
+async def get_message_by_link(
+        client: pyrogram.Client,
+        link: str,
+        single_link: bool = False  # 为True时,将每个链接都视作是单文件。
+) -> Union[dict, None]:
+    origin_link: str = link
+    chat_id, message_id, single_link, record_type, cache_key = __parse_message_link(link, single_link)
+    cache_meta: Union[dict, None] = MESSAGE_CACHE.get(cache_key)
+    if cache_meta:  # 重试或重复提交的链接直接使用已解析的结果。
+        return cache_meta
     comment_message: list = []
     if LinkType.COMMENT in record_type:
         # 如果用户需要同时下载媒体下面的评论,把评论中的所有信息放入列表一起返回。
@@ -171,11 +223,13 @@ async def get_message_by_link(
                 if '=' in origin_link and int(origin_link.split('=')[-1]) != comment.id:
                     continue
             comment_message.append(comment)
-    message = await client.get_messages(chat_id=chat_id, message_ids=message_id)
-    is_group, group_message = await __is_group(message)
-    if single_link:
+    message = PREFETCH_CACHE.pop((chat_id, message_id)) or \
+        await client.get_messages(chat_id=chat_id, message_ids=message_id)
+    if single_link:  # 视作单文件时无需获取媒体组中的其余消息。
         is_group = False
         group_message: Union[list, None] = None
+    else:
+        is_group, group_message = await __is_group(client, message)
     if is_group or comment_message:  # 组或评论区。
         try:  # v1.1.2解决当group返回None时出现comment无法下载的问题。
             group_message.extend(comment_message) if comment_message else None
@@ -184,26 +238,30 @@ async def get_message_by_link(
                 group_message: list = []
                 group_message.extend(comment_message)
         if comment_message:
-            return {
+            meta: dict = {
                 'link_type': LinkType.TOPIC if LinkType.TOPIC in record_type else LinkType.COMMENT,
                 'chat_id': chat_id,
                 'message': group_message,
                 'member_num': len(group_message)
             }
         else:
-            return {
+            meta: dict = {
                 'link_type': LinkType.TOPIC if LinkType.TOPIC in record_type else LinkType.GROUP,
                 'chat_id': chat_id,
                 'message': group_message,
                 'member_num': len(group_message)
             }
+        MESSAGE_CACHE.set(cache_key, meta)
+        return meta
     elif is_group is False and group_message is None:  # 单文件。
-        return {
+        meta: dict = {
             'link_type': LinkType.TOPIC if LinkType.TOPIC in record_type else LinkType.SINGLE,
             'chat_id': chat_id,
             'message': message,
             'member_num': 1
         }
+        MESSAGE_CACHE.set(cache_key, meta)
+        return meta
     elif is_group is None and group_message is None:
         raise MsgIdInvalid(
             'The message does not exist, the channel has been disbanded or is not in the channel.')
@@ -213,13 +271,39 @@ async def get_message_by_link(
         raise Exception('Unknown error.')
 
 
-async def __is_group(message) -> Tuple[Union[bool, None], Union[list, None]]:
+async def refresh_message(
+        client: pyrogram.Client,
+        message: pyrogram.types.Message
+) -> pyrogram.types.Message:
+    """只重新获取单条消息以刷新其中媒体的file_reference,不再重复解析链接与媒体组。"""
     try:
-        return True, await message.get_media_group()
-    except ValueError:
-        return False, None  # v1.0.4 修改单文件无法下载问题。
-    except AttributeError:
+        fresh = await client.get_messages(chat_id=message.chat.id, message_ids=message.id)
+        if fresh and not getattr(fresh, 'empty', False):
+            return fresh
+    except Exception:
+        pass
+    return message
+
+
+async def __is_group(client: pyrogram.Client, message) -> Tuple[Union[bool, None], Union[list, None]]:
+    """根据消息自带的media_group_id判断是否属于媒体组,只有属于媒体组时才获取其余消息,结果按媒体组缓存。"""
+    if message is None or getattr(message, 'empty', False) or getattr(message, 'chat', None) is None:
         return None, None
+    media_group_id: Union[str, None] = getattr(message, 'media_group_id', None)
+    if not media_group_id:
+        return False, None  # v1.0.4 修改单文件无法下载问题。
+    cache_key: tuple = (message.chat.id, media_group_id)
+    group_message: Union[list, None] = ALBUM_CACHE.get(cache_key)
+    if group_message is None:
+        # 媒体组最多10条消息,取前后各9条即可覆盖。
+        messages: list = await client.get_messages(
+            chat_id=message.chat.id,
+            message_ids=[_ for _ in range(max(message.id - 9, 1), message.id + 10)],
+            replies=0
+        )
+        group_message = [_ for _ in messages if _ and getattr(_, 'media_group_id', None) == media_group_id]
+        ALBUM_CACHE.set(cache_key, group_message)
+    return True, list(group_message)  # 调用方会向列表中追加评论,返回副本以免污染缓存。
 
 
 async def get_chat_with_notify(
@@ -0,0 +1,134 @@
+# coding=UTF-8
+# Author:Gentlesprite
+# Software:PyCharm
+# Time:2026/10/18 20:45
+# File:writer.py
+import os
+import time
+import queue
+import asyncio
+import threading
+
+from typing import Union, List
+
+from module.manifest import PartManifest
+
+
+class ChunkWriter:
+    """在独立线程中将下载的块写入文件,事件循环只负责投递,不再被磁盘IO阻塞。"""
+
+    def __init__(
+            self,
+            file_path: str,
+            max_queue: int = 16,
+            loop: Union[asyncio.AbstractEventLoop, None] = None,
+            manifest: Union[PartManifest, None] = None,
+            save_parts: int = 64,
+            save_interval: float = 5
+    ):
+        self.file_path: str = file_path
+        self.manifest: Union[PartManifest, None] = manifest
+        self.save_parts: int = save_parts  # 每新完成save_parts块或每隔save_interval秒才保存一次清单。
+        self.save_interval: float = save_interval
+        self.__unsaved: int = 0
+        self.__last_save: float = time.monotonic()
+        self.loop: asyncio.AbstractEventLoop = loop or asyncio.get_event_loop()
+        self.fd: int = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        self.error: Union[BaseException, None] = None
+        self.__queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.__slot = asyncio.Semaphore(max(max_queue, 1))  # 空闲槽位,耗尽即代表磁盘跟不上网络,此时才阻塞读取。
+        self.__done: asyncio.Future = self.loop.create_future()
+        self.__thread = threading.Thread(target=self.__run, name=f'ChunkWriter-{os.path.basename(file_path)}',
+                                         daemon=True)
+        self.__thread.start()
+
+    async def write(self, offset: int, chunk: bytes) -> None:
+        """将块投递到写入队列,队列已满时等待写入线程腾出槽位。"""
+        if self.error:
+            raise self.error
+        await self.__slot.acquire()
+        self.__queue.put((offset, chunk))
+
+    async def close(self) -> None:
+        """等待队列中剩余的块全部落盘后关闭文件,写入过程中出现的错误将在此抛出。"""
+        self.__queue.put(None)
+        await asyncio.shield(self.__done)
+        if self.error:
+            raise self.error
+
+    def __run(self) -> None:
+        closing: bool = False
+        try:
+            while not closing:
+                batch: list = [self.__queue.get()]
+                while True:  # 取出队列中已就绪的块,合并后一次写入。
+                    try:
+                        batch.append(self.__queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    closing = True
+                    batch = [_ for _ in batch if _ is not None]
+                try:
+                    if not self.error:
+                        for offset, buffers in self.__merge(batch):
+                            self.__write_at(self.fd, offset, buffers)
+                        if self.manifest:  # 数据写入后才记录到清单,崩溃时最多重新下载未记录的块。
+                            for offset, chunk in batch:
+                                self.manifest.mark(offset, len(chunk))
+                            self.__unsaved += len(batch)
+                            self.__checkpoint(closing)
+                except OSError as e:
+                    self.error = e
+                finally:
+                    self.loop.call_soon_threadsafe(self.__release, len(batch))
+        finally:
+            os.close(self.fd)
+            self.loop.call_soon_threadsafe(self.__finish)
+
+    def __checkpoint(self, closing: bool) -> None:
+        """按块数或时间间隔节流保存清单,保存前先fsync数据,使清单中标记完成的块一定已经落盘。"""
+        if not self.manifest.persistent or not self.__unsaved:
+            return None
+        if closing:
+            if self.manifest.is_complete():  # 完成后清单随即被删除,无需再保存。
+                return None
+        elif self.__unsaved < self.save_parts and time.monotonic() - self.__last_save < self.save_interval:
+            return None
+        os.fsync(self.fd)
+        self.manifest.save()
+        self.__unsaved = 0
+        self.__last_save = time.monotonic()
+
+    def __release(self, num: int) -> None:
+        for _ in range(num):
+            self.__slot.release()
+
+    def __finish(self) -> None:
+        if not self.__done.done():
+            self.__done.set_result(None)
+
+    @staticmethod
+    def __merge(batch: list) -> List[tuple]:
+        """将偏移连续的块合并为一组,每组只需一次向量写入。"""
+        groups: list = []
+        for offset, chunk in sorted(batch, key=lambda _: _[0]):
+            if groups and groups[-1][0] + groups[-1][2] == offset:
+                groups[-1][1].append(chunk)
+                groups[-1][2] += len(chunk)
+            else:
+                groups.append([offset, [chunk], len(chunk)])
+        return [(offset, buffers) for offset, buffers, _ in groups]
+
+    @staticmethod
+    def __write_at(fd: int, offset: int, buffers: list) -> None:
+        """在指定偏移处写入,支持时使用pwritev,否则退化为lseek+write。"""
+        written: int = 0
+        if hasattr(os, 'pwritev'):
+            written = os.pwritev(fd, buffers, offset)
+        view = memoryview(b''.join(buffers))[written:] if written < sum(map(len, buffers)) else memoryview(b'')
+        while view:
+            os.lseek(fd, offset + written, os.SEEK_SET)
+            n: int = os.write(fd, view)
+            written += n
+            view = view[n:]